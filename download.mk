@@ -8,26 +8,11 @@ DAY ?= 01
 
 date := $(YEAR)-$(MONTH)-$(DAY)
 
-psql = psql $(psqlflags)
-xz = xz --decompress --stdout
-
 archives = $(YEAR)/$(MONTH)/$(date)-bus-positions.csv.xz \
 	$(YEAR)/$(MONTH)/$(date)-bus-trip-updates.csv.xz \
 	$(YEAR)/$(MONTH)/$(date)-bus-messages.csv.xz \
 	$(YEAR)/$(MONTH)/$(date)-bus-alerts.csv.xz
 
-POSITION_COLS ?= timestamp,trip_id,route_id,trip_start_time,trip_start_date,\
-	vehicle_id,vehicle_label,vehicle_license_plate,latitude,longitude,bearing,\
-	speed,stop_id,stop_status,occupancy_status,congestion_level,progress,\
-	block_assigned,dist_along_route,dist_from_stop,mid,stop_sequence
-
-MESSAGE_COLS = oid,timestamp
-
-TRIP_UPDATE_COLS = oid,trip_id,route_id,trip_start_time,trip_start_date,\
-	schedule_relationship,vehicle_id,vehicle_label,vehicle_license_plate,timestamp,mid
-
-ALERT_COLS = oid,"start","end",cause,effect,url,header_text,description_text,mid
-
 ARCHIVE ?= s3
 
 ifeq ($(ARCHIVE),s3)
@@ -36,27 +21,33 @@ else ifeq ($(ARCHIVE),gcloud)
 ARCHIVE_URL = https://storage.googleapis.com/mta-bus-archive/$(YEAR)/$(MONTH)
 endif
 
-.PHONY: download load load-bus-positions load-trip-updates load-messages
+PYTHON = python
+PROTOC = protoc
+JOBS ?= 4
+
+.PHONY: download load load-bus-positions load-trip-updates load-messages backfill
 
 download: $(archives)
 
 load: load-bus-positions load-trip-updates load-messages
 
-load-bus-positions: $(YEAR)/$(MONTH)/$(date)-bus-positions.csv.xz
-	$(xz) $< \
-	| $(psql) -c "COPY rt.vehicle_positions ($(POSITION_COLS)) FROM STDIN (FORMAT CSV, HEADER true)"
+# Loads go through a staging table, so rows already in the database are skipped
+load-bus-positions: $(YEAR)/$(MONTH)/$(date)-bus-positions.csv.xz | src/gtfs_realtime_pb2.py
+	$(PYTHON) src/backfill.py --force --tables positions $(date)
 
-load-messages: $(YEAR)/$(MONTH)/$(date)-bus-messages.csv.xz
-	$(xz) $< \
-	| $(psql) -c "COPY rt.messages ($(MESSAGE_COLS)) FROM STDIN (FORMAT CSV, HEADER true)"
+load-messages: $(YEAR)/$(MONTH)/$(date)-bus-messages.csv.xz | src/gtfs_realtime_pb2.py
+	$(PYTHON) src/backfill.py --force --tables messages $(date)
 
-load-trip-updates: $(YEAR)/$(MONTH)/$(date)-bus-trip-updates.csv.xz
-	$(xz) $< \
-	| $(psql) -c "COPY rt.trip_updates ($(TRIP_UPDATE_COLS)) FROM STDIN (FORMAT CSV, HEADER true)"
+load-trip-updates: $(YEAR)/$(MONTH)/$(date)-bus-trip-updates.csv.xz | src/gtfs_realtime_pb2.py
+	$(PYTHON) src/backfill.py --force --tables trip-updates $(date)
 
-load-alerts: $(YEAR)/$(MONTH)/$(date)-bus-alerts.csv.xz
-	$(xz) $< \
-	| $(psql) -c 'COPY rt.alerts ($(ALERT_COLS)) FROM STDIN (FORMAT CSV, HEADER true)'
+load-alerts: $(YEAR)/$(MONTH)/$(date)-bus-alerts.csv.xz | src/gtfs_realtime_pb2.py
+	$(PYTHON) src/backfill.py --force --tables alerts $(date)
+
+# Download and load every day from START to END (YYYY-MM-DD), several files at once,
+# skipping any already in the database.
+backfill: | src/gtfs_realtime_pb2.py
+	$(PYTHON) src/backfill.py --archive $(ARCHIVE) --jobs $(JOBS) $(START) $(END)
 
 %.csv: %.csv.xz
 	xz -cd $< > $@
@@ -66,3 +57,6 @@ $(archives): %.csv.xz: | $(YEAR)/$(MONTH)
 
 $(YEAR)/$(MONTH):
 	mkdir -p $@
+
+src/gtfs_realtime_pb2.py: src/gtfs-realtime.proto
+	$(PROTOC) $< -I$(<D) --python_out=$(@D)
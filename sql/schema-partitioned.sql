@@ -0,0 +1,238 @@
+-- Alternative to schema.sql for PostgreSQL 11+.
+-- Messages, trip updates, stop time updates and vehicle positions are partitioned
+-- by UTC day, so that old data can be dropped a partition at a time.
+-- Run rt.create_partitions() daily to add upcoming partitions,
+-- and rt.drop_partitions() to detach and drop expired ones.
+-- backfill.py creates the partitions for past days with rt.create_day_partitions().
+BEGIN;
+CREATE SCHEMA rt;
+
+CREATE TYPE rt.alertcause AS ENUM (
+    'UNKNOWN_CAUSE',
+    'TECHNICAL_PROBLEM',
+    'ACCIDENT',
+    'HOLIDAY',
+    'WEATHER',
+    'MAINTENANCE',
+    'CONSTRUCTION',
+    'POLICE_ACTIVITY',
+    'MEDICAL_EMERGENCY'
+);
+CREATE TYPE rt.alerteffect AS ENUM (
+    'NO_SERVICE',
+    'REDUCED_SERVICE',
+    'SIGNIFICANT_DELAYS',
+    'DETOUR',
+    'ADDITIONAL_SERVICE',
+    'MODIFIED_SERVICE',
+    'OTHER_EFFECT',
+    'UNKNOWN_EFFECT',
+    'STOP_MOVED'
+);
+CREATE TYPE rt.congestionlevel AS ENUM (
+    'UNKNOWN_CONGESTION_LEVEL',
+    'RUNNING_SMOOTHLY',
+    'STOP_AND_GO',
+    'CONGESTION'
+);
+CREATE TYPE rt.occupancystatus AS ENUM (
+    'EMPTY',
+    'MANY_SEATS_AVAILABLE',
+    'FEW_SEATS_AVAILABLE',
+    'STANDING_ROOM_ONLY',
+    'CRUSHED_STANDING_ROOM_ONLY',
+    'FULL',
+    'NOT_ACCEPTING_PASSENGERS'
+);
+CREATE TYPE rt.stopstatus AS ENUM (
+    'INCOMING_AT',
+    'STOPPED_AT',
+    'IN_TRANSIT_TO'
+);
+CREATE TYPE rt.stoptimeschedule AS ENUM (
+    'SCHEDULED',
+    'SKIPPED',
+    'NO_DATA'
+);
+CREATE TYPE rt.tripschedule AS ENUM (
+    'SCHEDULED',
+    'ADDED',
+    'UNSCHEDULED',
+    'CANCELED'
+);
+CREATE TABLE rt.messages (
+    oid serial,
+    timestamp timestamp with time zone NOT NULL,
+    PRIMARY KEY (oid, timestamp)
+) PARTITION BY RANGE (timestamp);
+CREATE TABLE rt.alerts (
+    oid serial PRIMARY KEY,
+    mid bigint,
+    start timestamp with time zone,
+    "end" timestamp with time zone,
+    cause rt.alertcause,
+    effect rt.alerteffect,
+    url text,
+    header_text text,
+    description_text text
+);
+CREATE TABLE rt.entity_selectors (
+    oid serial PRIMARY KEY,
+    agency_id text,
+    route_id text,
+    route_type integer,
+    stop_id text,
+    trip_id text,
+    trip_route_id text,
+    trip_start_time interval,
+    trip_start_date date,
+    alert_id integer REFERENCES rt.alerts(oid) ON DELETE CASCADE
+);
+CREATE INDEX alerts_start_idx ON rt.alerts (start);
+CREATE INDEX entity_selectors_alert_id_idx ON rt.entity_selectors (alert_id);
+CREATE TABLE rt.trip_updates (
+    oid serial,
+    mid bigint,
+    trip_id text,
+    route_id text,
+    trip_start_time interval,
+    trip_start_date date,
+    schedule_relationship rt.tripschedule,
+    vehicle_id text,
+    vehicle_label text,
+    vehicle_license_plate text,
+    "timestamp" timestamp with time zone
+) PARTITION BY RANGE ("timestamp");
+CREATE INDEX trip_updates_oid_idx ON rt.trip_updates (oid);
+CREATE TABLE rt.stop_time_updates (
+    oid serial,
+    stop_sequence integer,
+    stop_id text,
+    arrival_delay integer,
+    arrival_time timestamp with time zone,
+    arrival_uncertainty integer,
+    departure_delay integer,
+    departure_time timestamp with time zone,
+    departure_uncertainty integer,
+    schedule_relationship rt.stoptimeschedule,
+    trip_id text,
+    trip_update_id integer,
+    "timestamp" timestamp with time zone
+) PARTITION BY RANGE ("timestamp");
+CREATE INDEX stop_time_updates_trip_update_id_idx ON rt.stop_time_updates (trip_update_id);
+CREATE TABLE rt.vehicle_positions (
+    "timestamp" timestamp with time zone NOT NULL,
+    trip_id text,
+    route_id text,
+    mid bigint,
+    trip_start_time interval,
+    trip_start_date date,
+    vehicle_id text NOT NULL,
+    vehicle_label text,
+    vehicle_license_plate text,
+    latitude numeric(9,6),
+    longitude numeric(9,6),
+    bearing numeric(5,2),
+    speed numeric(4,2),
+    stop_id text,
+    stop_sequence int,
+    stop_status rt.stopstatus,
+    occupancy_status rt.occupancystatus,
+    congestion_level rt.congestionlevel,
+    progress int,
+    block_assigned text,
+    dist_along_route numeric,
+    dist_from_stop numeric,
+    CONSTRAINT vehicle_positions_pkey PRIMARY KEY ("timestamp", vehicle_id)
+) PARTITION BY RANGE ("timestamp");
+
+-- Rows outside of any daily partition, including those without a timestamp
+CREATE TABLE rt.messages_default PARTITION OF rt.messages DEFAULT;
+CREATE TABLE rt.trip_updates_default PARTITION OF rt.trip_updates DEFAULT;
+CREATE TABLE rt.stop_time_updates_default PARTITION OF rt.stop_time_updates DEFAULT;
+CREATE TABLE rt.vehicle_positions_default PARTITION OF rt.vehicle_positions DEFAULT;
+
+-- Create daily partitions named e.g. rt.vehicle_positions_20170714
+-- for each day from first through last (UTC). Rows for those days already in a
+-- default partition, say from loading an old archive, are moved into the new one.
+CREATE FUNCTION rt.create_day_partitions(first date, last date) RETURNS void
+LANGUAGE plpgsql AS $$
+DECLARE
+    tbl text;
+    day date;
+    part text;
+    low timestamp with time zone;
+    high timestamp with time zone;
+BEGIN
+    -- backfill.py may create the same partitions from several connections
+    PERFORM pg_advisory_xact_lock(hashtext('rt.create_day_partitions'));
+    FOREACH tbl IN ARRAY ARRAY['messages', 'trip_updates', 'stop_time_updates', 'vehicle_positions'] LOOP
+        FOR day IN SELECT d::date FROM generate_series(first, last, interval '1 day') d LOOP
+            part := tbl || '_' || to_char(day, 'YYYYMMDD');
+            IF to_regclass(format('rt.%I', part)) IS NOT NULL THEN
+                CONTINUE;
+            END IF;
+            low := day::timestamp AT TIME ZONE 'UTC';
+            high := (day + 1)::timestamp AT TIME ZONE 'UTC';
+            EXECUTE format('CREATE TABLE rt.%I (LIKE rt.%I INCLUDING DEFAULTS)', part, tbl);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM rt.%I WHERE "timestamp" >= %L AND "timestamp" < %L RETURNING *) '
+                'INSERT INTO rt.%I SELECT * FROM moved',
+                tbl || '_default', low, high, part
+            );
+            EXECUTE format(
+                'ALTER TABLE rt.%I ATTACH PARTITION rt.%I FOR VALUES FROM (%L) TO (%L)',
+                tbl, part, low, high
+            );
+        END LOOP;
+    END LOOP;
+END
+$$;
+
+-- Create daily partitions from today through the given number of days ahead (UTC).
+CREATE FUNCTION rt.create_partitions(days integer DEFAULT 7) RETURNS void
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM rt.create_day_partitions(
+        (now() AT TIME ZONE 'UTC')::date,
+        (now() AT TIME ZONE 'UTC')::date + days
+    );
+END
+$$;
+
+-- Detach and drop daily partitions holding only data older than the given age,
+-- and delete expired rows from the default partitions.
+CREATE FUNCTION rt.drop_partitions(older_than interval DEFAULT '1 month') RETURNS void
+LANGUAGE plpgsql AS $$
+DECLARE
+    part record;
+    tbl text;
+BEGIN
+    FOR part IN
+        SELECT c.oid::regclass AS child, p.oid::regclass AS parent
+        FROM pg_inherits i
+            JOIN pg_class c ON (c.oid = i.inhrelid)
+            JOIN pg_class p ON (p.oid = i.inhparent)
+            JOIN pg_namespace n ON (n.oid = p.relnamespace)
+        WHERE n.nspname = 'rt'
+            AND p.relname IN ('messages', 'trip_updates', 'stop_time_updates', 'vehicle_positions')
+            AND c.relname ~ '_[0-9]{8}$'
+            AND to_date(right(c.relname, 8), 'YYYYMMDD') + 1
+                <= ((now() - older_than) AT TIME ZONE 'UTC')::date
+    LOOP
+        EXECUTE format('ALTER TABLE %s DETACH PARTITION %s', part.parent, part.child);
+        EXECUTE format('DROP TABLE %s', part.child);
+    END LOOP;
+
+    FOREACH tbl IN ARRAY ARRAY['messages', 'trip_updates', 'stop_time_updates', 'vehicle_positions'] LOOP
+        EXECUTE format(
+            'DELETE FROM rt.%I WHERE "timestamp" < now() - %L::interval',
+            tbl || '_default',
+            older_than
+        );
+    END LOOP;
+END
+$$;
+
+SELECT rt.create_partitions();
+COMMIT;
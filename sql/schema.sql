@@ -58,6 +58,7 @@ CREATE TABLE rt.messages (
     oid serial PRIMARY KEY,
     timestamp timestamp with time zone NOT NULL
 );
+CREATE INDEX messages_timestamp_idx ON rt.messages (timestamp);
 CREATE TABLE rt.alerts (
     oid serial PRIMARY KEY,
     mid bigint,
@@ -81,6 +82,8 @@ CREATE TABLE rt.entity_selectors (
     trip_start_date date,
     alert_id integer REFERENCES rt.alerts(oid) ON DELETE CASCADE
 );
+CREATE INDEX alerts_start_idx ON rt.alerts (start);
+CREATE INDEX entity_selectors_alert_id_idx ON rt.entity_selectors (alert_id);
 CREATE TABLE rt.trip_updates (
     oid serial PRIMARY KEY,
     mid bigint,
@@ -94,6 +97,7 @@ CREATE TABLE rt.trip_updates (
     vehicle_license_plate text,
     "timestamp" timestamp with time zone
 );
+CREATE INDEX trip_updates_timestamp_idx ON rt.trip_updates ("timestamp");
 CREATE TABLE rt.stop_time_updates (
     oid serial PRIMARY KEY,
     stop_sequence integer,
@@ -105,8 +109,11 @@ CREATE TABLE rt.stop_time_updates (
     departure_time timestamp with time zone,
     departure_uncertainty integer,
     schedule_relationship rt.stoptimeschedule,
-    trip_id text
+    trip_id text,
+    trip_update_id integer REFERENCES rt.trip_updates(oid) ON DELETE CASCADE,
+    "timestamp" timestamp with time zone
 );
+CREATE INDEX stop_time_updates_trip_update_id_idx ON rt.stop_time_updates (trip_update_id);
 CREATE TABLE rt.vehicle_positions (
     "timestamp" timestamp with time zone NOT NULL,
     trip_id text,
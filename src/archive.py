@@ -0,0 +1,101 @@
+# archive.py: keep every raw gtfs-realtime payload in compressed hourly files
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import io
+import lzma
+import time
+from functools import partial
+from spool import FRAME, read_frames
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EXTENSIONS = {"xz": ".frames.xz", "zstd": ".frames.zst"}
+
+# A full trip updates payload takes seconds to compress at xz's default preset, 6,
+# and a fraction of that at 1, for a little more space
+XZ_PRESET = 1
+
+
+def compressor(compression):
+    if compression == "xz":
+        return partial(lzma.compress, preset=XZ_PRESET)
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor().compress
+    raise ValueError("unknown compression {!r}".format(compression))
+
+
+class Archive:
+    """
+    Append-only archive of raw feed payloads, in files of length-prefixed frames
+    named DIRECTORY/NAME/YYYY/MM/DD/HH.frames.xz (or .frames.zst).
+    Each payload is compressed as a separate xz or zstd stream, so a file stays
+    readable up to its last complete payload if the writer is interrupted.
+    """
+
+    def __init__(self, directory, compression="xz"):
+        self.directory = directory
+        self.extension = EXTENSIONS[compression]
+        self.compress = compressor(compression)
+
+    def path(self, name, timestamp):
+        hour = time.strftime("%Y/%m/%d/%H", time.gmtime(timestamp))
+        return os.path.join(self.directory, name, hour + self.extension)
+
+    def append(self, name, payload, timestamp=None):
+        """Archive payload under name, in the file for the hour of timestamp (default: now)."""
+        path = self.path(name, timestamp or time.time())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "ab") as f:
+            f.write(self.compress(FRAME.pack(len(payload)) + payload))
+
+
+def open_frames(path):
+    """Open an archive file for reading, decompressing it as it's read."""
+    if path.endswith(EXTENSIONS["zstd"]):
+        if zstandard is None:
+            raise RuntimeError("reading {} requires the zstandard package".format(path))
+        f = open(path, "rb")
+        reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+        return io.BufferedReader(reader)
+    return lzma.open(path)
+
+
+def archive_name(path):
+    """The feed name of an archive file, e.g. positions for positions/2017/07/14/12.frames.xz."""
+    return os.path.normpath(path).split(os.sep)[-5]
+
+
+def archive_files(paths):
+    """Expand directories into the archive files they contain, in order."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                if filename.endswith(tuple(EXTENSIONS.values())):
+                    yield os.path.join(root, filename)
+
+
+def payloads(path):
+    """Yield every payload in an archive file."""
+    with open_frames(path) as f:
+        yield from read_frames(f)
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+# backfill.py: download archived days of bus data and load them into a database
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import csv
+import lzma
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import psycopg2
+import requests
+from gtfsrdb import open_connection, start_logger
+from export import day_range, export_path
+
+ARCHIVES = {
+    "s3": "https://s3.amazonaws.com/nycbuspositions",
+    "gcloud": "https://storage.googleapis.com/mta-bus-archive",
+}
+
+# Archived tables, with the column that places their rows in a day.
+TABLES = {
+    "positions": ("rt.vehicle_positions", '"timestamp"'),
+    "trip-updates": ("rt.trip_updates", '"timestamp"'),
+    "messages": ("rt.messages", '"timestamp"'),
+    "alerts": ("rt.alerts", "start"),
+}
+
+# Tables keyed by a serial oid rather than a natural key. Archived rows keep their
+# oids, which may since have been given to different rows scraped live.
+SERIAL_TABLES = {"trip-updates", "messages", "alerts"}
+
+# Archived tables that sql/schema-partitioned.sql partitions by day
+PARTITIONED_TABLES = {"positions", "trip-updates", "messages"}
+
+CHUNK = 2 ** 20
+
+# Rows merged from the staging table into the target per transaction
+STAGING_BATCH = 100000
+
+
+def md5sum(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def download(url, path, session=None):
+    """
+    Download url to path, resuming an earlier partial download with a Range request.
+    The file is checked against the server's ETag when that is an MD5 digest
+    (true for S3 objects not uploaded in parts), and only then moved into place.
+    Returns path, or None if the archive has no such file.
+    """
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    part = path + ".part"
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+
+    with (session or requests).get(url, headers=headers, stream=True, timeout=60) as r:
+        if r.status_code in (403, 404):
+            logging.warning("not found: %s", url)
+            return None
+        # 416 means the partial download is already complete
+        if r.status_code != 416:
+            r.raise_for_status()
+            mode = "ab" if r.status_code == 206 else "wb"
+            with open(part, mode) as f:
+                for chunk in r.iter_content(CHUNK):
+                    f.write(chunk)
+        etag = r.headers.get("ETag", "").strip('"')
+
+    if len(etag) == 32 and "-" not in etag and md5sum(part) != etag:
+        os.remove(part)
+        raise RuntimeError("checksum mismatch for {}".format(url))
+
+    os.replace(part, path)
+    logging.info("downloaded %s", path)
+    return path
+
+
+def is_loaded(conn, table, date):
+    """Check whether the database already has rows in table for date."""
+    name, column = TABLES[table]
+    sql = "SELECT EXISTS (SELECT 1 FROM {0} WHERE {1} >= %(start)s AND {1} < %(end)s)"
+    with conn.cursor() as cursor:
+        cursor.execute(sql.format(name, column), day_range(date))
+        return cursor.fetchone()[0]
+
+
+def create_partitions(conn, date):
+    """
+    With the partitioned schema, create the partitions for date, so that its rows
+    don't land in the default partitions.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT to_regprocedure('rt.create_day_partitions(date, date)') IS NOT NULL"
+        )
+        if cursor.fetchone()[0]:
+            cursor.execute("SELECT rt.create_day_partitions(%s, %s)", (date, date))
+    conn.commit()
+
+
+def load(conn, path, table, batch=STAGING_BATCH):
+    """
+    Stream a csv.xz archive into table, decompressing as it goes.
+    Columns are taken from the file's header, since they vary between archives.
+    Rows are copied into a temporary (so unlogged) staging table, then merged into
+    table batch rows at a time, each batch in its own transaction. Positions that
+    conflict with ones already there are skipped. In tables keyed by a serial oid,
+    rows whose oid is taken are skipped, those that differ from the row holding it
+    are counted and logged, and the oid sequence is first moved past the staged rows.
+    """
+    name, _ = TABLES[table]
+    serial = table in SERIAL_TABLES
+    with lzma.open(path, "rb") as f, conn.cursor() as cursor:
+        header = next(csv.reader([f.readline().decode("utf8")]))
+        columns = ", ".join('"{}"'.format(col) for col in header)
+        serial = serial and "oid" in header
+
+        cursor.execute(
+            "CREATE TEMPORARY TABLE staging (LIKE {} INCLUDING DEFAULTS)".format(name)
+        )
+        cursor.execute("ALTER TABLE staging ADD COLUMN staging_row bigserial")
+        cursor.copy_expert(
+            "COPY staging ({}) FROM STDIN (FORMAT CSV)".format(columns), f
+        )
+        cursor.execute("CREATE INDEX ON staging (staging_row)")
+        cursor.execute("SELECT coalesce(max(staging_row), 0) FROM staging")
+        (count,) = cursor.fetchone()
+        conn.commit()
+
+        sql = "INSERT INTO {0} ({1}) SELECT {1} FROM staging s "
+        sql += "WHERE staging_row > %s AND staging_row <= %s "
+        if serial:
+            # The partitioned schema has no unique index on oid to conflict on
+            sql += "AND NOT EXISTS (SELECT 1 FROM {0} t WHERE t.oid = s.oid)"
+        else:
+            sql += "ON CONFLICT DO NOTHING"
+        sql = sql.format(name, columns)
+        if serial:
+            # Before merging, so a live scraper can't be given an archived oid
+            advance_sequence(cursor, name)
+            conn.commit()
+
+        inserted = 0
+        for start in range(0, count, batch):
+            cursor.execute(sql, (start, start + batch))
+            inserted += cursor.rowcount
+            conn.commit()
+
+        collisions = 0
+        if serial:
+            collisions = count_collisions(cursor, name, header)
+
+        cursor.execute("DROP TABLE staging")
+        conn.commit()
+
+    if collisions:
+        logging.warning(
+            "%s: skipped %d rows whose oid belongs to a different row in %s",
+            path,
+            collisions,
+            name,
+        )
+    if inserted + collisions < count:
+        logging.info(
+            "%s: skipped %d rows already present", path, count - inserted - collisions
+        )
+
+
+def count_collisions(cursor, name, header):
+    """Count staged rows whose oid is held by a different row in table name."""
+    staged = ", ".join('s."{}"'.format(col) for col in header)
+    loaded = ", ".join('t."{}"'.format(col) for col in header)
+    cursor.execute(
+        "SELECT count(*) FROM staging s JOIN {} t ON t.oid = s.oid "
+        "WHERE ROW({}) IS DISTINCT FROM ROW({})".format(name, staged, loaded)
+    )
+    return cursor.fetchone()[0]
+
+
+def advance_sequence(cursor, name):
+    """Move the oid sequence of table name past the largest staged oid."""
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'oid')", (name,))
+    (sequence,) = cursor.fetchone()
+    if sequence:
+        cursor.execute(
+            "SELECT setval(%s, greatest((SELECT last_value FROM {}), "
+            "(SELECT max(oid) FROM staging)))".format(sequence),
+            (sequence,),
+        )
+
+
+def backfill(
+    date, table, directory=".", archive="s3", session=None, remove=False, force=False
+):
+    """
+    Download and load one table for one day, unless the database already has it.
+    With force, rows are loaded regardless, skipping any already present.
+    """
+    conn = open_connection()
+    try:
+        if not force and is_loaded(conn, table, date):
+            logging.info("skipping %s %s, already loaded", date, table)
+            return
+
+        path = export_path(directory, date, table, ".csv.xz")
+        filename = os.path.basename(path)
+        url = "/".join([ARCHIVES[archive], date.strftime("%Y/%m"), filename])
+        if download(url, path, session) is None:
+            return
+
+        if table in PARTITIONED_TABLES:
+            create_partitions(conn, date)
+        load(conn, path, table)
+        logging.info("loaded %s", path)
+        if remove:
+            os.remove(path)
+
+    finally:
+        conn.close()
+
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def main():
+    desc = """
+        Download archived days of MTA bus data and load them into a PostgreSQL database.
+        Days and tables already in the database are skipped, so backfill.py may be
+        rerun safely. Specify connection parameters using the standard PG* environment
+        variables.
+    """
+    parser = ArgumentParser(description=desc)
+    parser.add_argument(
+        "start", help="First date to load (YYYY-MM-DD)", type=parse_date
+    )
+    parser.add_argument(
+        "end",
+        nargs="?",
+        help="Last date to load (YYYY-MM-DD, default: START)",
+        type=parse_date,
+    )
+    parser.add_argument(
+        "--tables",
+        help="Comma-separated tables to load (default: all of {})".format(
+            ", ".join(TABLES)
+        ),
+        type=lambda x: x.split(","),
+        default=list(TABLES),
+    )
+    parser.add_argument(
+        "--archive",
+        help="Where to download from (default: s3)",
+        choices=tuple(ARCHIVES),
+        default="s3",
+    )
+    parser.add_argument(
+        "--jobs",
+        help="Files to download and load at once (default: 4)",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--directory", help="Download directory (default: .)", default="."
+    )
+    parser.add_argument(
+        "--remove", help="Delete each file once it's loaded", action="store_true"
+    )
+    parser.add_argument(
+        "--force",
+        help="Load days that already have data, merging in the missing rows",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    unknown = set(args.tables) - set(TABLES)
+    if unknown:
+        parser.error("unknown tables: " + ", ".join(sorted(unknown)))
+
+    start_logger(logging.INFO)
+
+    end = args.end or args.start
+    dates = [args.start + timedelta(days=i) for i in range((end - args.start).days + 1)]
+    session = requests.Session()
+    failed = False
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {
+            pool.submit(
+                backfill,
+                date,
+                table,
+                args.directory,
+                args.archive,
+                session,
+                args.remove,
+                args.force,
+            ): (date, table)
+            for date in dates
+            for table in args.tables
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except (
+                psycopg2.Error,
+                requests.RequestException,
+                lzma.LZMAError,
+                RuntimeError,
+                OSError,
+            ) as err:
+                date, table = futures[future]
+                logging.error("failed to load %s %s: %s", date, table, str(err).strip())
+                failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
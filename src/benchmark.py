@@ -0,0 +1,649 @@
+#!/usr/bin/env python3
+
+# benchmark.py: measure gtfsrdb.py against synthetic gtfs-realtime feeds
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from unittest import mock
+from argparse import ArgumentParser, SUPPRESS
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from google.protobuf.internal import api_implementation
+import gtfs_realtime_pb2
+import gtfsrdb
+
+try:
+    import pytz
+except ImportError:
+    pytz = None
+
+# Implementations that protobuf can be asked for, with PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION
+BACKENDS = ("upb", "cpp", "python")
+
+# Paths of the synthetic feeds, as on the BusTime API
+PATHS = {
+    "alerts": "/alerts",
+    "positions": "/vehiclePositions",
+    "trips": "/tripUpdates",
+}
+
+
+def header(fm, timestamp):
+    fm.header.gtfs_realtime_version = "1.0"
+    fm.header.timestamp = timestamp
+
+
+def make_positions(vehicles, timestamp, rng):
+    fm = gtfs_realtime_pb2.FeedMessage()
+    header(fm, timestamp)
+    for i in range(vehicles):
+        e = fm.entity.add()
+        e.id = str(i)
+        vp = e.vehicle
+        vp.trip.trip_id = "MTA NYCT_TRIP-{}".format(rng.randrange(100000))
+        vp.trip.route_id = "MTA NYCT_B{}".format(rng.randrange(100))
+        vp.trip.start_date = "20170714"
+        vp.vehicle.id = "MTA NYCT_{}".format(i)
+        vp.position.latitude = rng.uniform(40.5, 40.9)
+        vp.position.longitude = rng.uniform(-74.2, -73.7)
+        vp.position.bearing = rng.uniform(0, 360)
+        vp.stop_id = "MTA_{}".format(rng.randrange(300000, 310000))
+        vp.current_status = rng.randrange(3)
+        vp.timestamp = timestamp - rng.randrange(60)
+    return fm
+
+
+def make_trips(trips, stops, timestamp, rng):
+    fm = gtfs_realtime_pb2.FeedMessage()
+    header(fm, timestamp)
+    for i in range(trips):
+        e = fm.entity.add()
+        e.id = str(i)
+        tu = e.trip_update
+        tu.trip.trip_id = "MTA NYCT_TRIP-{}".format(i)
+        tu.trip.route_id = "MTA NYCT_B{}".format(rng.randrange(100))
+        tu.trip.start_date = "20170714"
+        tu.vehicle.id = "MTA NYCT_{}".format(i)
+        tu.timestamp = timestamp - rng.randrange(60)
+        arrival = timestamp
+        for seq in range(stops):
+            arrival += rng.randrange(30, 180)
+            stu = tu.stop_time_update.add()
+            stu.stop_sequence = seq
+            stu.stop_id = "MTA_{}".format(rng.randrange(300000, 310000))
+            stu.arrival.time = arrival
+            stu.departure.time = arrival
+    return fm
+
+
+def make_alerts(alerts, selectors, timestamp, rng):
+    fm = gtfs_realtime_pb2.FeedMessage()
+    header(fm, timestamp)
+    for i in range(alerts):
+        e = fm.entity.add()
+        e.id = str(i)
+        alert = e.alert
+        period = alert.active_period.add()
+        period.start = timestamp - 3600
+        period.end = timestamp + 3600
+        for _ in range(selectors):
+            selector = alert.informed_entity.add()
+            selector.agency_id = "MTA NYCT"
+            selector.route_id = "MTA NYCT_B{}".format(rng.randrange(100))
+        alert.cause = rng.choice([1, 3, 6, 7, 8, 9, 10, 11, 12])
+        alert.effect = rng.randrange(1, 10)
+        text = alert.header_text.translation.add()
+        text.text = "Buses are detoured"
+        text.language = "EN"
+        text = alert.description_text.translation.add()
+        text.text = "Buses are detoured because of construction. " * 4
+        text.language = "EN"
+    return fm
+
+
+def make_feeds(args, timestamp=None, seed=0):
+    """Serialized synthetic feeds, at the scale given in args."""
+    rng = random.Random(seed)
+    timestamp = timestamp or int(time.time())
+    return {
+        "alerts": make_alerts(args.alerts, args.selectors, timestamp, rng),
+        "positions": make_positions(args.vehicles, timestamp, rng),
+        "trips": make_trips(args.trips, args.stops, timestamp, rng),
+    }
+
+
+def serve(payloads):
+    """Serve payloads (a dict of path to bytes) from a local HTTP server, returning its URL."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = payloads.get(self.path.split("?")[0])
+            if body is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-protobuf")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}".format(server.server_port)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def rows(kind, args):
+    if kind == "positions":
+        return args.vehicles
+    if kind == "trips":
+        return args.trips
+    if kind == "stoptimes":
+        return args.trips * (args.stops + 1)
+    return args.alerts * (args.selectors + 1)
+
+
+def ingest(args):
+    """
+    Fetch each synthetic feed from a local server, parse it, and write it with each
+    insert function, rolling back after every iteration so runs don't interfere.
+    """
+    feeds = make_feeds(args)
+    payloads = {PATHS[kind]: fm.SerializeToString() for kind, fm in feeds.items()}
+    server, url = serve(payloads)
+    session = requests.Session()
+
+    # (feed, kind, loader) to measure
+    cases = [("alerts", "alerts", "insert")]
+    cases += [("positions", "positions", loader) for loader in args.loaders]
+    cases += [("trips", "trips", "insert"), ("trips", "stoptimes", "insert")]
+    cases += [
+        ("trips", "stoptimes", loader)
+        for loader in args.loaders
+        if loader in gtfsrdb.STOPTIME_LOADERS
+    ]
+    # The same inserts through server-side prepared statements, as a daemon writes them
+    cases += [("alerts", "alerts", "prepared"), ("trips", "trips", "prepared")]
+
+    results = []
+    plain = gtfsrdb.open_connection()
+    prepared = gtfsrdb.open_connection(connection_factory=gtfsrdb.PreparedConnection)
+    try:
+        for feed, kind, loader in cases:
+            if loader == "prepared":
+                conn, insert = prepared, gtfsrdb.insert_functions()[kind]
+            else:
+                conn, insert = plain, gtfsrdb.insert_functions(loader)[kind]
+            timings = {"fetch": [], "parse": [], "header": [], "insert": [], "db": []}
+            for _ in range(args.iterations):
+                (content, _), elapsed = timed(gtfsrdb.fetch, url + PATHS[feed], session)
+                timings["fetch"].append(elapsed)
+                (message, _), elapsed = timed(gtfsrdb.parse_message, content, url)
+                timings["parse"].append(elapsed)
+                with conn.cursor(cursor_factory=gtfsrdb.TimedCursor) as cursor:
+                    messageid, elapsed = timed(gtfsrdb.insert_header, cursor, message)
+                    timings["header"].append(elapsed)
+                    waited = cursor.seconds
+                    _, elapsed = timed(insert, cursor, messageid, message.entity)
+                    timings["insert"].append(elapsed)
+                    # Time the insert function spent waiting on the database
+                    timings["db"].append(cursor.seconds - waited)
+                conn.rollback()
+
+            best = {stage: min(values) for stage, values in timings.items()}
+            results.append(
+                {
+                    "kind": kind,
+                    "loader": loader,
+                    "function": insert.__name__,
+                    "bytes": len(payloads[PATHS[feed]]),
+                    "rows": rows(kind, args),
+                    "seconds": best,
+                    "rows_per_second": rows(kind, args) / best["insert"],
+                }
+            )
+    finally:
+        plain.close()
+        prepared.close()
+        server.shutdown()
+
+    return results
+
+
+def legacy_fromtimestamp(timestamp):
+    """fromtimestamp as it was before its fast path, pytz and all, for comparison."""
+    try:
+        if timestamp == 0:
+            raise TypeError("Ignoring timestamp at epoch")
+
+        # Some fields pass the timestamp in ms, some in sec
+        if timestamp > 568971820800:
+            timestamp = timestamp / 1000.0
+
+        return datetime.utcfromtimestamp(timestamp).replace(tzinfo=pytz.UTC)
+
+    except TypeError:
+        return None
+
+    except ValueError:
+        raise ValueError("Error converting timestamp {}".format(timestamp))
+
+
+def legacy_getenum(cls, value, default=None):
+    """getenum as it was before enum names were precomputed, for comparison."""
+    try:
+        return cls(value).name
+    except ValueError:
+        if default:
+            return cls(default).name
+        return None
+
+
+def time_parser(parse, items, iterations, clear=None):
+    """Best time of iterations to parse every item, calling clear before each."""
+    best = float("inf")
+    for _ in range(iterations):
+        if clear is not None:
+            clear()
+        start = time.perf_counter()
+        for item in items:
+            parse(item)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def parse(args):
+    """
+    Time the parse_* functions on the synthetic feeds, and again with the legacy
+    fromtimestamp and getenum in their place. Needs no database.
+    """
+    feeds = make_feeds(args)
+    trips = [e.trip_update for e in feeds["trips"].entity]
+    cases = [
+        ("positions", gtfsrdb.parse_vehicle, list(feeds["positions"].entity)),
+        ("trips", gtfsrdb.parse_trip, trips),
+        (
+            "stoptimes",
+            gtfsrdb.parse_stoptimeupdate,
+            [stu for trip in trips for stu in trip.stop_time_update],
+        ),
+        ("alerts", gtfsrdb.parse_alert, [e.alert for e in feeds["alerts"].entity]),
+    ]
+    results = []
+    for kind, parser, items in cases:
+        # Clear the timestamp cache each time, since every iteration is the same feed
+        clear = gtfsrdb.fromtimestamp.cache_clear
+        seconds = time_parser(parser, items, args.iterations, clear)
+        with mock.patch.multiple(
+            gtfsrdb, fromtimestamp=legacy_fromtimestamp, getenum=legacy_getenum
+        ):
+            legacy = time_parser(parser, items, args.iterations)
+        results.append(
+            {
+                "kind": kind,
+                "rows": len(items),
+                "seconds": seconds,
+                "legacy_seconds": legacy,
+                "speedup": legacy / seconds,
+            }
+        )
+    return results
+
+
+def report_parse(results):
+    line = "{:<10} {:>8} {:>9} {:>9} {:>8}"
+    print(line.format("kind", "rows", "parse", "legacy", "speedup"))
+    for r in results:
+        print(
+            line.format(
+                r["kind"],
+                r["rows"],
+                "{:.4f}".format(r["seconds"]),
+                "{:.4f}".format(r["legacy_seconds"]),
+                "{:.1f}x".format(r["speedup"]),
+            )
+        )
+
+
+def extract(messages):
+    """Run every entity in messages through the parse_* functions."""
+    for message in messages:
+        for entity in message.entity:
+            if entity.HasField("vehicle"):
+                gtfsrdb.parse_vehicle(entity)
+            if entity.HasField("trip_update"):
+                gtfsrdb.parse_trip(entity.trip_update)
+                for stu in entity.trip_update.stop_time_update:
+                    gtfsrdb.parse_stoptimeupdate(stu)
+            if entity.HasField("alert"):
+                gtfsrdb.parse_alert(entity.alert)
+
+
+def protobuf_stage(args):
+    """Time decoding the synthetic feeds, and reading them with parse_*, in this process."""
+    payloads = [fm.SerializeToString() for fm in make_feeds(args).values()]
+    decode, read = float("inf"), float("inf")
+    for _ in range(args.iterations):
+        messages, elapsed = timed(
+            lambda: [gtfsrdb.parse_message(p, "benchmark")[0] for p in payloads]
+        )
+        decode = min(decode, elapsed)
+        gtfsrdb.fromtimestamp.cache_clear()
+        _, elapsed = timed(extract, messages)
+        read = min(read, elapsed)
+    return {
+        "backend": api_implementation.Type(),
+        "bytes": sum(len(p) for p in payloads),
+        "entities": sum(len(m.entity) for m in messages),
+        "decode": decode,
+        "read": read,
+    }
+
+
+def protobuf(args):
+    """
+    Time protobuf_stage under each backend. The backend is fixed when protobuf is
+    imported, so each is run in a subprocess. Backends that aren't available, or
+    that protobuf silently replaces with another, are left out.
+    """
+    command = [sys.executable, os.path.abspath(__file__), "--protobuf-stage", "--json"]
+    for option in ("vehicles", "trips", "stops", "alerts", "selectors", "iterations"):
+        command += ["--" + option, str(getattr(args, option))]
+
+    results = []
+    for backend in BACKENDS:
+        env = dict(os.environ, PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=backend)
+        proc = subprocess.run(
+            command, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        if proc.returncode:
+            print("{} backend unavailable".format(backend), file=sys.stderr)
+            continue
+        result = json.loads(proc.stdout)
+        if result["backend"] != backend:
+            continue
+        results.append(result)
+    return results
+
+
+def report_protobuf(results):
+    line = "{:<8} {:>10} {:>9} {:>9} {:>9}"
+    print(line.format("backend", "bytes", "entities", "decode", "read"))
+    for r in results:
+        print(
+            line.format(
+                r["backend"],
+                r["bytes"],
+                r["entities"],
+                "{:.4f}".format(r["decode"]),
+                "{:.4f}".format(r["read"]),
+            )
+        )
+
+
+# Read back what a loader wrote for a message, in a stable order and without
+# the serial keys that differ from one run to the next
+READBACK = {
+    "positions": "SELECT {} FROM rt.vehicle_positions WHERE mid = %s "
+    'ORDER BY vehicle_id, "timestamp"'.format(", ".join(gtfsrdb.VEHICLE_COLS[1:])),
+    "stoptimes": "SELECT {} FROM rt.stop_time_updates s "
+    "JOIN rt.trip_updates t ON (s.trip_update_id = t.oid) WHERE t.mid = %s "
+    "ORDER BY s.trip_id, s.stop_sequence".format(
+        ", ".join("s." + col for col in gtfsrdb.STOPTIME_COLS if col != "trip_update_id")
+    ),
+}
+
+
+def readback(conn, kind, loader, message):
+    """Write message with a loader and read the rows back, then roll back."""
+    insert = gtfsrdb.insert_functions(loader)[kind]
+    with conn.cursor() as cursor:
+        messageid = gtfsrdb.insert_header(cursor, message)
+        insert(cursor, messageid, message.entity)
+        cursor.execute(READBACK[kind], (messageid,))
+        rows = cursor.fetchall()
+    conn.rollback()
+    return rows
+
+
+def verify(args):
+    """Check that the binary COPY loader writes the same rows as text COPY."""
+    feeds = make_feeds(args)
+    results = []
+    conn = gtfsrdb.open_connection()
+    try:
+        for kind, feed in (("positions", "positions"), ("stoptimes", "trips")):
+            expected = readback(conn, kind, "copy", feeds[feed])
+            actual = readback(conn, kind, "binary", feeds[feed])
+            mismatched = sum(a != b for a, b in zip(expected, actual))
+            mismatched += abs(len(expected) - len(actual))
+            results.append({"kind": kind, "rows": len(expected), "mismatched": mismatched})
+    finally:
+        conn.close()
+    return results
+
+
+def report_verify(results):
+    for r in results:
+        status = "ok" if not r["mismatched"] else "{} rows differ".format(r["mismatched"])
+        print("{:<10} {:>8} rows: {}".format(r["kind"], r["rows"], status))
+
+
+# Count the rows written for the messages with a header timestamp
+MESSAGES = 'SELECT oid FROM rt.messages WHERE "timestamp" = to_timestamp(%s)'
+COUNTS = {
+    "rt.messages": "SELECT count(*) FROM ({}) m".format(MESSAGES),
+    "rt.vehicle_positions": "SELECT count(*) FROM rt.vehicle_positions "
+    "WHERE mid IN ({})".format(MESSAGES),
+    "rt.trip_updates": "SELECT count(*) FROM rt.trip_updates "
+    "WHERE mid IN ({})".format(MESSAGES),
+    "rt.stop_time_updates": "SELECT count(*) FROM rt.stop_time_updates s "
+    "JOIN rt.trip_updates t ON (s.trip_update_id = t.oid) "
+    "WHERE t.mid IN ({})".format(MESSAGES),
+    "rt.alerts": "SELECT count(*) FROM rt.alerts WHERE mid IN ({})".format(MESSAGES),
+    "rt.entity_selectors": "SELECT count(*) FROM rt.entity_selectors s "
+    "JOIN rt.alerts a ON (s.alert_id = a.oid) WHERE a.mid IN ({})".format(MESSAGES),
+}
+
+
+def end_to_end(args):
+    """
+    Run gtfsrdb.py on the synthetic feeds, as cron would, with a state file, a spool
+    and a metrics file, then count the rows it committed. It runs twice: the second
+    run should find every feed unchanged and write nothing.
+    """
+    timestamp = int(time.time())
+    feeds = make_feeds(args, timestamp)
+    payloads = {PATHS[kind]: fm.SerializeToString() for kind, fm in feeds.items()}
+    server, url = serve(payloads)
+    expected = {
+        "rt.messages": len(feeds),
+        "rt.vehicle_positions": args.vehicles,
+        "rt.trip_updates": args.trips,
+        "rt.stop_time_updates": args.trips * args.stops,
+        "rt.alerts": args.alerts,
+        "rt.entity_selectors": args.alerts * args.selectors,
+    }
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gtfsrdb.py")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            command = [
+                sys.executable,
+                script,
+                "--state-file", os.path.join(tmp, "state.json"),
+                "--spool", os.path.join(tmp, "spool"),
+                "--metrics-file", os.path.join(tmp, "metrics.json"),
+                "--feed", "positions=" + url + PATHS["positions"],
+                "--feed", "trips,stoptimes=" + url + PATHS["trips"],
+                "--feed", "alerts=" + url + PATHS["alerts"],
+            ]
+            for _ in range(2):
+                subprocess.run(command, check=True)
+    finally:
+        server.shutdown()
+
+    results = []
+    conn = gtfsrdb.open_connection()
+    try:
+        with conn.cursor() as cursor:
+            for table, sql in COUNTS.items():
+                cursor.execute(sql, (timestamp,))
+                count = cursor.fetchone()[0]
+                results.append(
+                    {"table": table, "expected": expected[table], "rows": count}
+                )
+    finally:
+        conn.close()
+    return results
+
+
+def report_end_to_end(results):
+    for r in results:
+        status = "ok"
+        if r["rows"] != r["expected"]:
+            status = "expected {}".format(r["expected"])
+        print("{:<22} {:>8} rows: {}".format(r["table"], r["rows"], status))
+
+
+def report(results):
+    line = "{:<10} {:<8} {:<24} {:>10} {:>8} {:>9} {:>9} {:>9} {:>9} {:>12}"
+    headings = ("kind", "loader", "function", "bytes", "rows")
+    print(line.format(*headings, "fetch", "parse", "insert", "db", "rows/s"))
+    for r in results:
+        s = r["seconds"]
+        print(
+            line.format(
+                r["kind"],
+                r["loader"],
+                r["function"],
+                r["bytes"],
+                r["rows"],
+                "{:.4f}".format(s["fetch"]),
+                "{:.4f}".format(s["parse"]),
+                "{:.4f}".format(s["insert"]),
+                "{:.4f}".format(s["db"]),
+                "{:.0f}".format(r["rows_per_second"]),
+            )
+        )
+
+
+def main():
+    desc = """
+        Benchmark gtfsrdb.py on synthetic feeds served locally. Times are the best of
+        several iterations. Specify connection parameters for a scratch database
+        using the standard PG* environment variables.
+    """
+    parser = ArgumentParser(description=desc)
+    parser.add_argument("--vehicles", type=int, default=6000, help="default: 6000")
+    parser.add_argument("--trips", type=int, default=6000, help="default: 6000")
+    parser.add_argument(
+        "--stops", type=int, default=20, help="Stop time updates per trip (default: 20)"
+    )
+    parser.add_argument("--alerts", type=int, default=200, help="default: 200")
+    parser.add_argument(
+        "--selectors", type=int, default=20, help="Selectors per alert (default: 20)"
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=5, help="Runs of each case (default: 5)"
+    )
+    parser.add_argument(
+        "--loaders",
+        help="Comma-separated position loaders to compare (default: all)",
+        type=lambda x: x.split(","),
+        default=list(gtfsrdb.LOADERS),
+    )
+    parser.add_argument(
+        "--parse",
+        help="Only time the parse_* functions, against their legacy helpers",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--protobuf",
+        help="Only time decoding and reading the feeds, with each protobuf backend",
+        action="store_true",
+    )
+    parser.add_argument("--protobuf-stage", help=SUPPRESS, action="store_true")
+    parser.add_argument(
+        "--verify",
+        help="Check that binary COPY writes the same rows as text COPY, "
+        "exiting with an error if not",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--end-to-end",
+        help="Run gtfsrdb.py twice on the feeds, as cron would, and check the rows it "
+        "commits, exiting with an error if they're wrong",
+        action="store_true",
+    )
+    parser.add_argument("--json", help="Print results as JSON", action="store_true")
+    args = parser.parse_args()
+
+    if args.parse and pytz is None:
+        parser.error("--parse requires the pytz package, which the legacy code used: "
+            "pip install -r requirements-benchmark.txt")
+
+    unknown = set(args.loaders) - set(gtfsrdb.LOADERS)
+    if unknown:
+        parser.error("unknown loaders: " + ", ".join(sorted(unknown)))
+
+    if args.protobuf_stage:
+        results = protobuf_stage(args)
+    elif args.protobuf:
+        results = protobuf(args)
+    elif args.parse:
+        results = parse(args)
+    elif args.verify:
+        results = verify(args)
+    elif args.end_to_end:
+        results = end_to_end(args)
+    else:
+        results = ingest(args)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+    elif args.protobuf:
+        report_protobuf(results)
+    elif args.parse:
+        report_parse(results)
+    elif args.verify:
+        report_verify(results)
+    elif args.end_to_end:
+        report_end_to_end(results)
+    else:
+        report(results)
+
+    if args.verify and any(r["mismatched"] for r in results):
+        sys.exit(1)
+    if args.end_to_end and any(r["rows"] != r["expected"] for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
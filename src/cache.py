@@ -0,0 +1,113 @@
+# cache.py: remember each vehicle's last stored position, to skip repeats
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+EARTH_RADIUS = 6371000.0
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Approximate distance in metres between two nearby points, in degrees."""
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return EARTH_RADIUS * math.hypot(x, y)
+
+
+class PositionCache:
+    """
+    The last stored state (latitude, longitude, stop_id and timestamp) of each
+    vehicle, used to drop positions that repeat it, as BusTime does poll after poll
+    for buses that are parked or laying over.
+    With min_distance, positions less than that many metres from the stored one are
+    dropped as well, unless the stop has changed.
+    Vehicles missing from the feed for max_missed polls are forgotten, and the
+    least recently seen are evicted beyond max_vehicles.
+    Feeds may be stored from several threads at once, so filtering is locked.
+    """
+
+    def __init__(self, min_distance=0, max_vehicles=20000, max_missed=20):
+        self.min_distance = min_distance
+        self.max_vehicles = max_vehicles
+        self.max_missed = max_missed
+        self.polls = 0
+        self.lock = threading.Lock()
+        # vehicle_id: (state, poll last seen), least recently seen first
+        self.vehicles = OrderedDict()
+
+    def changed(self, vp):
+        """Check whether a VehiclePosition differs from its vehicle's stored state."""
+        key = vp.vehicle.id
+        if not key:
+            return True
+        state = (vp.position.latitude, vp.position.longitude, vp.stop_id, vp.timestamp)
+
+        last = self.vehicles.pop(key, None)
+        if last is not None:
+            stored = last[0]
+            if stored == state:
+                self.vehicles[key] = (stored, self.polls)
+                return False
+            if (
+                self.min_distance
+                and stored[2] == state[2]
+                and distance(stored[0], stored[1], state[0], state[1]) < self.min_distance
+            ):
+                self.vehicles[key] = (stored, self.polls)
+                return False
+
+        self.vehicles[key] = (state, self.polls)
+        return True
+
+    def filter(self, entities):
+        """The entities with vehicle positions that have changed, recording them as stored."""
+        with self.lock:
+            self.polls += 1
+            kept = [
+                e for e in entities if e.HasField("vehicle") and self.changed(e.vehicle)
+            ]
+            self.evict()
+            return kept
+
+    def evict(self):
+        """Forget vehicles not seen lately, oldest first, and any over max_vehicles."""
+        while self.vehicles:
+            key, (_, seen) = next(iter(self.vehicles.items()))
+            missed = self.polls - seen
+            if len(self.vehicles) <= self.max_vehicles and missed < self.max_missed:
+                break
+            del self.vehicles[key]
+
+    def clear(self):
+        """Forget every vehicle, e.g. after positions may have failed to be stored."""
+        with self.lock:
+            self.vehicles.clear()
+
+    def wrap(self, insert):
+        """
+        Wrap a vehicle position insert function to insert only changed positions.
+        If the insert fails, every vehicle is forgotten, since none may be stored.
+        """
+
+        @wraps(insert)
+        def wrapper(cursor, messageid, entities):
+            try:
+                return insert(cursor, messageid, self.filter(entities))
+            except Exception:
+                self.clear()
+                raise
+
+        return wrapper
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+# export.py: save a day of real-time data from the database to compressed csv files
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import logging
+import subprocess
+from datetime import datetime, timedelta, timezone
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+from gtfsrdb import open_connection, start_logger
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Queries for each exported table, selecting the UTC day from %(start)s to %(end)s.
+TABLES = {
+    "positions": """SELECT * FROM rt.vehicle_positions
+        WHERE "timestamp" >= %(start)s AND "timestamp" < %(end)s""",
+    "alerts": """SELECT * FROM rt.alerts a
+        WHERE a.start >= %(start)s AND a.start < %(end)s""",
+    "trip-updates": """SELECT * FROM rt.trip_updates
+        WHERE "timestamp" >= %(start)s AND "timestamp" < %(end)s""",
+    "messages": """SELECT * FROM rt.messages
+        WHERE "timestamp" >= %(start)s AND "timestamp" < %(end)s""",
+    "entity-selectors": """SELECT * FROM rt.entity_selectors e
+        JOIN rt.alerts AS a ON (e.alert_id = a.oid)
+        WHERE a.start >= %(start)s AND a.start < %(end)s""",
+}
+
+COPY = "COPY ({query}) TO STDOUT WITH (FORMAT CSV, HEADER true)"
+
+COMPRESSORS = {
+    "xz": (".csv.xz", ["xz", "--compress", "--stdout", "--threads={threads}"]),
+    "zstd": (".csv.zst", ["zstd", "--quiet", "--stdout", "-T{threads}"]),
+}
+
+
+# Typed columns for Parquet files, and the order of their rows.
+# Column kinds are: int, float, text, enum, timestamp, date and interval.
+PARQUET = {
+    "positions": {
+        "table": "rt.vehicle_positions",
+        "time": '"timestamp"',
+        "order": 'route_id, vehicle_id, "timestamp"',
+        "columns": [
+            ("timestamp", "timestamp"),
+            ("trip_id", "text"),
+            ("route_id", "text"),
+            ("mid", "int"),
+            ("trip_start_time", "interval"),
+            ("trip_start_date", "date"),
+            ("vehicle_id", "text"),
+            ("vehicle_label", "text"),
+            ("vehicle_license_plate", "text"),
+            ("latitude", "float"),
+            ("longitude", "float"),
+            ("bearing", "float"),
+            ("speed", "float"),
+            ("stop_id", "text"),
+            ("stop_sequence", "int"),
+            ("stop_status", "enum"),
+            ("occupancy_status", "enum"),
+            ("congestion_level", "enum"),
+            ("progress", "int"),
+            ("block_assigned", "text"),
+            ("dist_along_route", "float"),
+            ("dist_from_stop", "float"),
+        ],
+    },
+    "alerts": {
+        "table": "rt.alerts",
+        "time": "start",
+        "order": "start, oid",
+        "columns": [
+            ("oid", "int"),
+            ("mid", "int"),
+            ("start", "timestamp"),
+            ("end", "timestamp"),
+            ("cause", "enum"),
+            ("effect", "enum"),
+            ("url", "text"),
+            ("header_text", "text"),
+            ("description_text", "text"),
+        ],
+    },
+    "trip-updates": {
+        "table": "rt.trip_updates",
+        "time": '"timestamp"',
+        "order": 'route_id, vehicle_id, "timestamp"',
+        "columns": [
+            ("oid", "int"),
+            ("mid", "int"),
+            ("trip_id", "text"),
+            ("route_id", "text"),
+            ("trip_start_time", "interval"),
+            ("trip_start_date", "date"),
+            ("schedule_relationship", "enum"),
+            ("vehicle_id", "text"),
+            ("vehicle_label", "text"),
+            ("vehicle_license_plate", "text"),
+            ("timestamp", "timestamp"),
+        ],
+    },
+    "messages": {
+        "table": "rt.messages",
+        "time": '"timestamp"',
+        "order": '"timestamp"',
+        "columns": [("oid", "int"), ("timestamp", "timestamp")],
+    },
+    "entity-selectors": {
+        "table": "rt.entity_selectors e JOIN rt.alerts a ON (e.alert_id = a.oid)",
+        "time": "a.start",
+        "order": "e.alert_id, e.oid",
+        "columns": [
+            ("e.oid", "int"),
+            ("e.agency_id", "text"),
+            ("e.route_id", "text"),
+            ("e.route_type", "int"),
+            ("e.stop_id", "text"),
+            ("e.trip_id", "text"),
+            ("e.trip_route_id", "text"),
+            ("e.trip_start_time", "interval"),
+            ("e.trip_start_date", "date"),
+            ("e.alert_id", "int"),
+        ],
+    },
+}
+
+# SQL casts and Arrow types for each kind of column.
+KINDS = {
+    "int": ("bigint", lambda: pyarrow.int64()),
+    "float": ("double precision", lambda: pyarrow.float64()),
+    "text": ("text", lambda: pyarrow.string()),
+    "enum": ("text", lambda: pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+    "timestamp": ("timestamptz", lambda: pyarrow.timestamp("us", tz="UTC")),
+    "date": ("date", lambda: pyarrow.date32()),
+    "interval": ("interval", lambda: pyarrow.duration("us")),
+}
+
+# Rows fetched from the database, and written to the file, at a time.
+PARQUET_BATCH = 250000
+
+
+def day_range(date):
+    start = datetime(date.year, date.month, date.day, tzinfo=timezone.utc)
+    return {"start": start, "end": start + timedelta(days=1)}
+
+
+def export_path(directory, date, table, extension):
+    filename = "{}-bus-{}{}".format(date, table, extension)
+    return os.path.join(directory, date.strftime("%Y"), date.strftime("%m"), filename)
+
+
+def export_table(table, date, directory=".", compression="xz", threads=0):
+    """
+    Stream one table's rows for a day through COPY into a compressor process.
+    The file is written under a temporary name and renamed once complete.
+    """
+    extension, command = COMPRESSORS[compression]
+    path = export_path(directory, date, table, extension)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+
+    conn = open_connection()
+    try:
+        with open(tmp, "wb") as out, conn.cursor() as cursor:
+            args = [a.format(threads=threads) for a in command]
+            proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=out)
+            try:
+                sql = cursor.mogrify(COPY.format(query=TABLES[table]), day_range(date))
+                cursor.copy_expert(sql, proc.stdin)
+            finally:
+                proc.stdin.close()
+                returncode = proc.wait()
+        if returncode:
+            raise RuntimeError("{} exited with status {}".format(args[0], returncode))
+        os.replace(tmp, path)
+
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    finally:
+        conn.close()
+
+    logging.info("wrote %s", path)
+    return path
+
+
+def parquet_array(values, kind):
+    if kind == "enum":
+        return pyarrow.array(values, pyarrow.string()).dictionary_encode()
+    return pyarrow.array(values, KINDS[kind][1]())
+
+
+def export_parquet(table, date, directory="."):
+    """
+    Write one table's rows for a day to a Parquet file with typed columns,
+    reading from a server-side cursor so that memory use is bounded.
+    Enums are dictionary-encoded, and rows are sorted so that row group
+    statistics allow filtering, e.g. on route_id for positions.
+    """
+    spec = PARQUET[table]
+    path = export_path(directory, date, table, ".parquet")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+
+    columns = [col.rpartition(".") for col, _ in spec["columns"]]
+    names = [name for _, _, name in columns]
+    kinds = [kind for _, kind in spec["columns"]]
+    schema = pyarrow.schema(
+        [(name, KINDS[kind][1]()) for name, kind in zip(names, kinds)]
+    )
+    select = ", ".join(
+        '{}{}"{}"::{} AS "{}"'.format(prefix, dot, name, KINDS[kind][0], name)
+        for (prefix, dot, name), kind in zip(columns, kinds)
+    )
+    query = (
+        "SELECT {select} FROM {table} WHERE {time} >= %(start)s AND {time} < %(end)s "
+        "ORDER BY {order}"
+    ).format(select=select, **spec)
+
+    conn = open_connection()
+    try:
+        with conn.cursor(name="export_parquet") as cursor:
+            cursor.itersize = PARQUET_BATCH
+            cursor.execute(query, day_range(date))
+            with pyarrow.parquet.ParquetWriter(tmp, schema, compression="zstd") as writer:
+                while True:
+                    rows = cursor.fetchmany(PARQUET_BATCH)
+                    if not rows:
+                        break
+                    columns = zip(*rows)
+                    arrays = [parquet_array(list(c), k) for c, k in zip(columns, kinds)]
+                    writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+        os.replace(tmp, path)
+
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    finally:
+        conn.close()
+
+    logging.info("wrote %s", path)
+    return path
+
+
+def main():
+    desc = """
+        Export a UTC day of real-time data to compressed csv files,
+        one per table, named YYYY/MM/YYYY-MM-DD-bus-TABLE.csv.xz.
+        Specify connection parameters using the standard PG* environment variables.
+    """
+    parser = ArgumentParser(description=desc)
+    parser.add_argument(
+        "date",
+        help="Date to export (YYYY-MM-DD)",
+        type=lambda x: datetime.strptime(x, "%Y-%m-%d").date(),
+    )
+    parser.add_argument(
+        "--tables",
+        help="Comma-separated tables to export (default: all of {})".format(
+            ", ".join(TABLES)
+        ),
+        type=lambda x: x.split(","),
+        default=list(TABLES),
+    )
+    parser.add_argument(
+        "--compression",
+        help="Compression program (default: xz)",
+        choices=tuple(COMPRESSORS),
+        default="xz",
+    )
+    parser.add_argument(
+        "--threads",
+        help="Threads for each compressor, 0 to use every core (default: 0)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--parquet",
+        help="Also write each table to a Parquet file (requires pyarrow)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--directory", help="Output directory (default: .)", default="."
+    )
+    args = parser.parse_args()
+
+    if args.parquet and pyarrow is None:
+        parser.error("--parquet requires the pyarrow package")
+
+    unknown = set(args.tables) - set(TABLES)
+    if unknown:
+        parser.error("unknown tables: " + ", ".join(sorted(unknown)))
+
+    start_logger(logging.INFO)
+
+    try:
+        # Each table is exported on its own connection, all at once
+        workers = len(args.tables) * (2 if args.parquet else 1)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(
+                    export_table,
+                    table,
+                    args.date,
+                    args.directory,
+                    args.compression,
+                    args.threads,
+                )
+                for table in args.tables
+            ]
+            if args.parquet:
+                futures.extend(
+                    pool.submit(export_parquet, table, args.date, args.directory)
+                    for table in args.tables
+                )
+            for future in futures:
+                future.result()
+
+    except (psycopg2.Error, RuntimeError, OSError) as err:
+        logging.error("export failed: %s", str(err).strip())
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
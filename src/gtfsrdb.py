@@ -21,21 +21,39 @@
 # Authors:
 # Neil Freeman
 
+import io
+import csv
 import os
 import sys
+import json
+import time
+import hashlib
 import getpass
-from datetime import datetime
-from argparse import ArgumentParser
+from datetime import datetime, timezone
+from argparse import ArgumentParser, ArgumentTypeError
+from collections import namedtuple
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
 import logging
-import pytz
+import queue
+import threading
+from array import array
+from contextlib import contextmanager
 import psycopg2
 from psycopg2.extras import execute_values
 import requests
 import google.protobuf
+from google.protobuf.internal import api_implementation
 import gtfs_realtime_pb2
 
 # import nyct_subway_pb2
 import model
+import pgcopy
+from spool import Spool, read_frames
+from archive import Archive
+from metrics import Metrics, Stopwatch, new_sample
+from cache import PositionCache
 
 
 INSERT = "INSERT INTO {table} ({columns}) VALUES %s ON CONFLICT DO NOTHING"
@@ -45,30 +63,175 @@ def insert_stmt(table, columns):
     return INSERT.format(table=table, columns=", ".join(columns)).strip()
 
 
-def insert_stmt_returning(table, columns, returning):
-    placeholders = "(" + ("%s, " * len(columns)).strip(" ,") + ")"
-    return (
-        (INSERT.format(table=table, columns=", ".join(columns)) % placeholders)
-        + " RETURNING "
-        + returning
-    )
+def insert_rows(cursor, table, columns, rows):
+    """
+    Insert rows in a single statement, prepared if the connection allows.
+    Returns the number of rows inserted.
+    """
+    if not rows:
+        return 0
+    if isinstance(cursor.connection, PreparedConnection):
+        cursor.connection.execute_prepared(cursor, table, columns, rows)
+    else:
+        execute_values(cursor, insert_stmt(table, columns), rows, page_size=len(rows))
+    return cursor.rowcount
 
 
-def fromtimestamp(timestamp):
-    try:
-        if timestamp == 0:
-            raise TypeError("Ignoring timestamp at epoch")
+def insert_returning(cursor, table, columns, rows, returning="oid"):
+    """
+    Insert rows in a single statement, returning one value per row in input order.
+    Callers match the values to rows by position, so conflicts aren't skipped but
+    raise an IntegrityError.
+    """
+    if not rows:
+        return []
+    if isinstance(cursor.connection, PreparedConnection):
+        conn = cursor.connection
+        result = conn.execute_prepared(cursor, table, columns, rows, returning)
+    else:
+        sql = "INSERT INTO {} ({}) VALUES %s RETURNING {}".format(
+            table, ", ".join(columns), returning
+        )
+        result = execute_values(cursor, sql, rows, page_size=len(rows), fetch=True)
+    return [r[0] for r in result]
+
+
+COLUMN_TYPES = """
+    SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute
+    WHERE attrelid = %s::regclass AND attname = ANY(%s)
+"""
 
-        # Some fields pass the timestamp in ms, some in sec
-        if timestamp > 568971820800:
-            timestamp = timestamp/1000.
+PREPARE = (
+    "PREPARE {name} ({types}) AS INSERT INTO {table} ({columns}) "
+    "SELECT * FROM unnest({params})"
+)
 
-        return datetime.utcfromtimestamp(timestamp).replace(tzinfo=pytz.UTC)
 
-    except TypeError:
+class PreparedConnection(psycopg2.extensions.connection):
+    """
+    A connection on which insert_rows and insert_returning use server-side prepared
+    statements, so that the server plans each insert once per session rather than
+    once per message. Each statement takes an array for every column and unnests
+    them, so a batch of any size is still inserted with one statement.
+    Statements are prepared on first use and last as long as the connection.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (table, columns, returning): EXECUTE statement
+        self.statements = {}
+
+    def prepare(self, cursor, table, columns, returning=None):
+        """Prepare an insert into table, returning the SQL that executes it."""
+        key = (table, tuple(columns), returning)
+        if key not in self.statements:
+            names = [column.strip('"') for column in columns]
+            cursor.execute(COLUMN_TYPES, (table, names))
+            types = dict(cursor.fetchall())
+            arrays = [types[name] + "[]" for name in names]
+            name = "gtfsrdb_insert_{:d}".format(len(self.statements))
+            sql = PREPARE.format(
+                name=name,
+                types=", ".join(arrays),
+                table=table,
+                columns=", ".join(columns),
+                params=", ".join("${:d}".format(i + 1) for i in range(len(columns))),
+            )
+            # As in insert_rows and insert_returning
+            if returning:
+                sql += " RETURNING " + returning
+            else:
+                sql += " ON CONFLICT DO NOTHING"
+            cursor.execute(sql)
+            params = ", ".join("%s::" + array for array in arrays)
+            self.statements[key] = "EXECUTE {} ({})".format(name, params)
+        return self.statements[key]
+
+    def execute_prepared(self, cursor, table, columns, rows, returning=None):
+        """Insert rows with a prepared statement, fetching the result if returning."""
+        sql = self.prepare(cursor, table, columns, returning)
+        cursor.execute(sql, [list(values) for values in zip(*rows)])
+        return cursor.fetchall() if returning else None
+
+
+class ConnectionPool:
+    """
+    Up to size database connections shared by threads, opened with connect as
+    they're needed and kept open between uses. A connection that fails with an
+    OperationalError is closed, so that the next thread to need one reconnects.
+    """
+
+    def __init__(self, size, connect):
+        self.connect = connect
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = queue.LifoQueue()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection, rolling back anything left uncommitted on error."""
+        with self.slots:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = None
+            if conn is None or conn.closed:
+                conn = self.connect()
+            try:
+                yield conn
+            except psycopg2.OperationalError:
+                conn.close()
+                raise
+            except BaseException:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                if not conn.closed:
+                    self.idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def copy_rows(cursor, table, columns, rows):
+    """Stream rows into table with COPY ... FROM STDIN."""
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    sql = "COPY {table} ({columns}) FROM STDIN (FORMAT CSV)"
+    cursor.copy_expert(sql.format(table=table, columns=", ".join(columns)), buf)
+
+
+def copy_binary(cursor, table, columns, rows):
+    """Stream rows of encoded fields (see pgcopy) into table with binary COPY."""
+    buf = io.BytesIO()
+    pgcopy.write_rows(buf, rows)
+    buf.seek(0)
+    sql = "COPY {table} ({columns}) FROM STDIN (FORMAT binary)"
+    cursor.copy_expert(sql.format(table=table, columns=", ".join(columns)), buf)
+
+
+@lru_cache(maxsize=4096)
+def fromtimestamp(timestamp):
+    """
+    Convert a POSIX timestamp to an aware UTC datetime, or None for a missing (0)
+    timestamp. Feeds repeat the same few timestamps many times over, e.g. in the
+    arrival and departure times of stop time updates, so conversions are cached.
+    """
+    if not timestamp:
         return None
 
-    except ValueError:
+    # Some fields pass the timestamp in ms, some in sec
+    if timestamp > 568971820800:
+        timestamp = timestamp / 1000.0
+
+    try:
+        return datetime.fromtimestamp(timestamp, timezone.utc)
+    except (ValueError, OverflowError, OSError):
         raise ValueError("Error converting timestamp {}".format(timestamp))
 
 
@@ -89,6 +252,43 @@ def get_translated(translation, lang=None):
     return translation[0].text
 
 
+class TimedCursor(psycopg2.extensions.cursor):
+    """A cursor that adds up the seconds it spends waiting on the database."""
+
+    seconds = 0.0
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+def log_protobuf_backend():
+    """
+    Log the protobuf implementation parsing feeds: upb, cpp or the slow python,
+    which is the only one worth a warning.
+    """
+    backend = api_implementation.Type()
+    if backend == "python":
+        logging.warning(
+            "WARNING: protobuf %s is using its pure-Python backend, which is slow. "
+            "Install protobuf 4.21 or later to use upb.",
+            google.protobuf.__version__,
+        )
+    else:
+        logging.info("protobuf %s, %s backend", google.protobuf.__version__, backend)
+    return backend
+
+
 def start_logger(level):
     logger = logging.getLogger()
     logger.setLevel(level)
@@ -99,22 +299,48 @@ def start_logger(level):
 
 
 def getenum(cls, value, default=None):
-    try:
-        return cls(value).name
-    except ValueError:
-        if default:
-            return cls(default).name
-        return None
+    """Name of the member of enum cls with value, or else of default, if that's given."""
+    names = model.NAMES[cls]
+    name = names.get(value)
+    if name is None and default:
+        return names[default]
+    return name
 
 
-def load_message(url):
+# Seconds to wait for a feed's server to accept a connection or send data
+HTTP_TIMEOUT = 30
+
+
+def fetch(url, session=None, state=None, timeout=HTTP_TIMEOUT):
+    """
+    Download a feed, waiting up to timeout seconds for the server to respond.
+    Returns the payload and the response's cache validators.
+    If state holds validators from an earlier response, the request is conditional,
+    and the payload is None if the feed hasn't been modified.
+    """
+    headers = {"Accept-Encoding": "gzip"}
+    if state and state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    if state and state.get("last_modified"):
+        headers["If-Modified-Since"] = state["last_modified"]
+
+    with (session or requests).get(url, headers=headers, timeout=timeout) as r:
+        validators = {
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+        }
+        if r.status_code == 304:
+            return None, validators
+        return r.content, validators
+
+
+def parse_message(content, url):
     fm = gtfs_realtime_pb2.FeedMessage()
-    with requests.get(url) as r:
-        try:
-            fm.ParseFromString(r.content)
-        except (RuntimeWarning, google.protobuf.message.DecodeError) as e:
-            logging.error("ERROR: %s in %s", e, url)
-            return fm, e
+    try:
+        fm.ParseFromString(content)
+    except (RuntimeWarning, google.protobuf.message.DecodeError) as e:
+        logging.error("ERROR: %s in %s", e, url)
+        return fm, e
     # Check the feed version
     if fm.entity and fm.header.gtfs_realtime_version != "1.0":
         logging.warning(
@@ -126,6 +352,40 @@ def load_message(url):
     return fm, None
 
 
+def load_message(url, session=None):
+    content, _ = fetch(url, session)
+    return parse_message(content, url)
+
+
+def feed_key(url):
+    """Identify a feed by its URL without the query string, which holds the API key."""
+    return urlsplit(url)._replace(query="", fragment="").geturl()
+
+
+def read_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_state(path, states):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(states, f)
+    os.replace(tmp, path)
+
+
+def write_metrics(path, metrics):
+    line = metrics.json_line() + "\n"
+    if path == "-":
+        sys.stdout.write(line)
+        return
+    with open(path, "a") as f:
+        f.write(line)
+
+
 def parse_vehicle(entity):
     vp = entity.vehicle
     # nyct_trip_descriptor = vp.trip.Extensions[nyct_subway_pb2.nyct_trip_descriptor]
@@ -151,31 +411,231 @@ def parse_vehicle(entity):
     ]
 
 
+VEHICLE_COLS = (
+    "mid",
+    "trip_id",
+    "route_id",
+    "trip_start_time",
+    "trip_start_date",
+    "stop_id",
+    "stop_sequence",
+    "stop_status",
+    "vehicle_id",
+    "vehicle_label",
+    "vehicle_license_plate",
+    "latitude",
+    "longitude",
+    "bearing",
+    "speed",
+    "occupancy_status",
+    "congestion_level",
+    "timestamp",
+)
+
+
 def insert_vehicles(cursor, messageid, entities):
-    cols = [
-        "mid",
-        "trip_id",
-        "route_id",
-        "trip_start_time",
-        "trip_start_date",
-        "stop_id",
-        "stop_sequence",
-        "stop_status",
-        "vehicle_id",
-        "vehicle_label",
-        "vehicle_license_plate",
-        "latitude",
-        "longitude",
-        "bearing",
-        "speed",
-        "occupancy_status",
-        "congestion_level",
-        "timestamp",
-    ]
+    sql = insert_stmt("rt.vehicle_positions", VEHICLE_COLS)
+    rows = [[messageid] + parse_vehicle(e) for e in entities if e.HasField("vehicle")]
+    if not rows:
+        return 0
+    execute_values(cursor, sql, rows, page_size=len(rows))
+    return cursor.rowcount
+
+
+def copy_vehicles(cursor, messageid, entities):
+    """
+    Load vehicle positions with COPY into a temporary staging table,
+    then merge into rt.vehicle_positions, skipping rows already present.
+    """
+    create_vehicle_staging(cursor)
+    parsed = ([messageid] + parse_vehicle(e) for e in entities if e.HasField("vehicle"))
+    copy_rows(cursor, "vehicle_positions_staging", VEHICLE_COLS, parsed)
+    return merge_vehicle_staging(cursor)
+
+
+def create_vehicle_staging(cursor):
+    cursor.execute(
+        "CREATE TEMPORARY TABLE IF NOT EXISTS vehicle_positions_staging "
+        "(LIKE rt.vehicle_positions INCLUDING DEFAULTS)"
+    )
+
+
+def merge_vehicle_staging(cursor):
+    """Merge the staging table into rt.vehicle_positions, returning rows inserted."""
+    cols = ", ".join(VEHICLE_COLS)
+    cursor.execute(
+        "INSERT INTO rt.vehicle_positions ({0}) "
+        "SELECT {0} FROM vehicle_positions_staging ON CONFLICT DO NOTHING".format(cols)
+    )
+    inserted = cursor.rowcount
+    cursor.execute("TRUNCATE vehicle_positions_staging")
+    return inserted
+
+
+# Escapes for strings in COPY's text format, where \N is NULL
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def vehicle_columns(entities):
+    """
+    Read vehicle positions in one pass over the entities, into one column for
+    each of VEHICLE_COLS after mid. Numbers go into compact arrays, and strings
+    are interned, since ids and enum names repeat from row to row and poll to poll.
+    As in the feed, zero and the empty string stand for missing values, with the
+    exceptions made by parse_vehicle for the occupancy and congestion enums.
+    """
+    intern = sys.intern
+    texts = {
+        "trip_id": [],
+        "route_id": [],
+        "trip_start_time": [],
+        "trip_start_date": [],
+        "stop_id": [],
+        "stop_status": [],
+        "vehicle_id": [],
+        "vehicle_label": [],
+        "vehicle_license_plate": [],
+        "occupancy_status": [],
+        "congestion_level": [],
+    }
+    numbers = {
+        "stop_sequence": array("q"),
+        "latitude": array("d"),
+        "longitude": array("d"),
+        "bearing": array("d"),
+        "speed": array("d"),
+        "timestamp": array("q"),
+    }
+    for entity in entities:
+        if not entity.HasField("vehicle"):
+            continue
+        vp = entity.vehicle
+        trip, vehicle, position = vp.trip, vp.vehicle, vp.position
+        texts["trip_id"].append(intern(trip.trip_id))
+        texts["route_id"].append(intern(trip.route_id))
+        texts["trip_start_time"].append(intern(trip.start_time))
+        texts["trip_start_date"].append(intern(trip.start_date))
+        texts["stop_id"].append(intern(vp.stop_id))
+        texts["stop_status"].append(getenum(model.StopStatus, vp.current_status))
+        texts["vehicle_id"].append(intern(vehicle.id))
+        texts["vehicle_label"].append(intern(vehicle.label))
+        texts["vehicle_license_plate"].append(intern(vehicle.license_plate))
+        texts["occupancy_status"].append(
+            getenum(model.OccupancyStatus, vp.occupancy_status)
+        )
+        texts["congestion_level"].append(
+            getenum(model.CongestionLevel, vp.congestion_level, 0)
+        )
+        numbers["stop_sequence"].append(vp.current_stop_sequence)
+        numbers["latitude"].append(position.latitude)
+        numbers["longitude"].append(position.longitude)
+        numbers["bearing"].append(position.bearing)
+        numbers["speed"].append(position.speed)
+        numbers["timestamp"].append(vp.timestamp)
+
+    return dict(texts, **numbers)
 
-    sql = insert_stmt("rt.vehicle_positions", cols)
-    parsed = ([messageid] + parse_vehicle(e) for e in entities if e.vehicle.ByteSize())
-    execute_values(cursor, sql, list(parsed))
+
+def write_vehicle_columns(f, messageid, columns):
+    """
+    Write vehicle columns to f as rows in COPY's text format, formatting each
+    distinct timestamp once rather than once per row.
+    """
+    stamps = {}
+    for ts in set(columns["timestamp"]):
+        dt = fromtimestamp(ts)
+        stamps[ts] = dt.isoformat() if dt else "\\N"
+
+    formats = []
+    for col in VEHICLE_COLS[1:]:
+        if col == "timestamp":
+            formats.append(stamps.__getitem__)
+        elif isinstance(columns[col], array):
+            formats.append(lambda x: repr(x) if x else "\\N")
+        else:
+            formats.append(lambda x: x.translate(COPY_ESCAPES) if x else "\\N")
+
+    prefix = str(messageid) + "\t"
+    cols = [columns[col] for col in VEHICLE_COLS[1:]]
+    for values in zip(*cols):
+        f.write(prefix + "\t".join(fmt(v) for fmt, v in zip(formats, values)) + "\n")
+
+
+def columnar_vehicles(cursor, messageid, entities):
+    """
+    Load vehicle positions like copy_vehicles, but read them into columns and
+    write them straight into the COPY buffer, without building a list per row.
+    """
+    create_vehicle_staging(cursor)
+    buf = io.StringIO()
+    write_vehicle_columns(buf, messageid, vehicle_columns(entities))
+    buf.seek(0)
+    sql = "COPY vehicle_positions_staging ({}) FROM STDIN"
+    cursor.copy_expert(sql.format(", ".join(VEHICLE_COLS)), buf)
+    return merge_vehicle_staging(cursor)
+
+
+# Staging table for binary COPY of vehicle positions. Its columns have types with
+# simple binary formats, and are cast into rt.vehicle_positions when merged.
+VEHICLE_BINARY = (
+    ("mid", "bigint", "mid"),
+    ("trip_id", "text", "trip_id"),
+    ("route_id", "text", "route_id"),
+    ("trip_start_time", "text", "trip_start_time::interval"),
+    ("trip_start_date", "text", "trip_start_date::date"),
+    ("stop_id", "text", "stop_id"),
+    ("stop_sequence", "integer", "stop_sequence"),
+    ("stop_status", "text", "stop_status::rt.stopstatus"),
+    ("vehicle_id", "text", "vehicle_id"),
+    ("vehicle_label", "text", "vehicle_label"),
+    ("vehicle_license_plate", "text", "vehicle_license_plate"),
+    ("latitude", "double precision", "latitude"),
+    ("longitude", "double precision", "longitude"),
+    ("bearing", "double precision", "bearing"),
+    ("speed", "double precision", "speed"),
+    ("occupancy_status", "text", "occupancy_status::rt.occupancystatus"),
+    ("congestion_level", "text", "congestion_level::rt.congestionlevel"),
+    ("timestamp", "timestamp with time zone", '"timestamp"'),
+)
+
+# Encoders for binary COPY by staging column type. Zero means missing for every
+# number in a vehicle position, as it does in vehicle_columns.
+BINARY_ENCODERS = {
+    "text": pgcopy.text,
+    "integer": lambda x: pgcopy.int4(x or None),
+    "double precision": lambda x: pgcopy.float8(x or None),
+    "timestamp with time zone": pgcopy.timestamp,
+}
+
+
+def binary_vehicles(cursor, messageid, entities):
+    """
+    Load vehicle positions with binary COPY, encoding them straight from the
+    columns read by vehicle_columns, into a staging table of plain types that
+    the server needn't parse. They're cast while being merged into rt.vehicle_positions.
+    """
+    cursor.execute(
+        "CREATE TEMPORARY TABLE IF NOT EXISTS vehicle_positions_binary ({})".format(
+            ", ".join('"{}" {}'.format(col, kind) for col, kind, _ in VEHICLE_BINARY)
+        )
+    )
+    columns = vehicle_columns(entities)
+    encoders = [BINARY_ENCODERS[kind] for _, kind, _ in VEHICLE_BINARY[1:]]
+    values = [columns[col] for col, _, _ in VEHICLE_BINARY[1:]]
+    mid = pgcopy.int8(messageid)
+    rows = (
+        [mid] + [encode(v) for encode, v in zip(encoders, row)] for row in zip(*values)
+    )
+    copy_binary(cursor, "vehicle_positions_binary", VEHICLE_COLS, rows)
+    cursor.execute(
+        "INSERT INTO rt.vehicle_positions ({}) SELECT {} FROM vehicle_positions_binary "
+        "ON CONFLICT DO NOTHING".format(
+            ", ".join(VEHICLE_COLS), ", ".join(expr for _, _, expr in VEHICLE_BINARY)
+        )
+    )
+    inserted = cursor.rowcount
+    cursor.execute("TRUNCATE vehicle_positions_binary")
+    return inserted
 
 
 def parse_alert(alert):
@@ -229,23 +689,20 @@ def insert_alerts(cursor, messageid, entities):
         "alert_id",
     )
 
-    alerts = [e.alert for e in entities if e.alert.ByteSize()]
-    if not alerts:
-        return
+    alerts = [e.alert for e in entities if e.HasField("alert")]
+    parsed = [(alert, parse_alert(alert)) for alert in alerts]
+    parsed = [(alert, row) for alert, row in parsed if row]
 
-    alertsql = insert_stmt_returning("rt.alerts", alert_cols, "oid")
-    selectorsql = insert_stmt("rt.entity_selectors", entity_cols)
+    rows = [[messageid] + row for _, row in parsed]
+    oids = insert_returning(cursor, "rt.alerts", alert_cols, rows)
 
-    for alert in alerts:
-        parsed = parse_alert(alert)
-        if not parsed:
-            continue
-        cursor.execute(alertsql, [messageid] + parsed)
-        oid = cursor.fetchone()[0]
-
-        selectors = [parse_informed_entity(e) + (oid,) for e in alert.informed_entity]
-        if selectors:
-            execute_values(cursor, selectorsql, selectors)
+    selectors = [
+        parse_informed_entity(e) + (oid,)
+        for (alert, _), oid in zip(parsed, oids)
+        for e in alert.informed_entity
+    ]
+    inserted = insert_rows(cursor, "rt.entity_selectors", entity_cols, selectors)
+    return len(oids) + inserted
 
 
 def parse_trip(trip_update):
@@ -280,53 +737,97 @@ def parse_stoptimeupdate(entity):
     ]
 
 
-def insert_trips(cursor, messageid, entities):
-    cols = (
-        "mid",
-        "trip_id",
-        "route_id",
-        "trip_start_time",
-        "trip_start_date",
-        "schedule_relationship",
-        "vehicle_id",
-        "vehicle_label",
-        "vehicle_license_plate",
-        "timestamp",
-    )
-    trips = [e.trip_update for e in entities if e.trip_update.ByteSize()]
-    if not trips:
-        return
+TRIP_COLS = (
+    "mid",
+    "trip_id",
+    "route_id",
+    "trip_start_time",
+    "trip_start_date",
+    "schedule_relationship",
+    "vehicle_id",
+    "vehicle_label",
+    "vehicle_license_plate",
+    "timestamp",
+)
 
-    tripsql = insert_stmt_returning("rt.trip_updates", cols, "oid")
 
-    for trip in trips:
-        cursor.execute(tripsql, [messageid] + parse_trip(trip))
+def insert_trip_updates(cursor, messageid, entities):
+    """Insert trip updates, returning the trip updates and their oids in entity order."""
+    trips = [e.trip_update for e in entities if e.HasField("trip_update")]
+    rows = [[messageid] + parse_trip(trip) for trip in trips]
+    return trips, insert_returning(cursor, "rt.trip_updates", TRIP_COLS, rows)
+
+
+def insert_trips(cursor, messageid, entities):
+    """Insert trip updates without their stop time updates."""
+    _, oids = insert_trip_updates(cursor, messageid, entities)
+    return len(oids)
+
+
+STOPTIME_COLS = (
+    "stop_sequence",
+    "stop_id",
+    "arrival_delay",
+    "arrival_time",
+    "arrival_uncertainty",
+    "departure_delay",
+    "departure_time",
+    "departure_uncertainty",
+    "schedule_relationship",
+    "trip_id",
+    "trip_update_id",
+    "timestamp",
+)
 
 
 def insert_stoptime_updates(cursor, messageid, entities):
-    stu_cols = (
-        "stop_sequence",
-        "stop_id",
-        "arrival_delay",
-        "arrival_time",
-        "arrival_uncertainty",
-        "departure_delay",
-        "departure_time",
-        "departure_uncertainty",
-        "schedule_relationship",
-        "trip_update_id",
-    )
-    trips = [e.trip_update for e in entities if e.trip_update.ByteSize()]
-    if not trips:
-        return
+    """
+    Insert trip updates, then COPY all of their stop time updates in one batch,
+    keyed to the oids of the new trip updates and stamped with their timestamps.
+    """
+    trips, oids = insert_trip_updates(cursor, messageid, entities)
+    stus = []
+    for trip, oid in zip(trips, oids):
+        keys = [trip.trip.trip_id, oid, fromtimestamp(trip.timestamp)]
+        stus.extend(parse_stoptimeupdate(stu) + keys for stu in trip.stop_time_update)
+    copy_rows(cursor, "rt.stop_time_updates", STOPTIME_COLS, stus)
+    return len(oids) + len(stus)
+
+
+def encode_stoptimeupdate(entity):
+    """Encode a stop time update for binary COPY, as parse_stoptimeupdate parses it."""
+    arrival, departure = entity.arrival, entity.departure
+    return [
+        pgcopy.int4(entity.stop_sequence),  # stop_sequence
+        pgcopy.text(entity.stop_id),  # stop_id
+        pgcopy.int4(arrival.delay or None),  # arrival_delay
+        pgcopy.timestamp(arrival.time),  # arrival_time
+        pgcopy.int4(arrival.uncertainty or None),  # arrival_uncertainty
+        pgcopy.int4(departure.delay or None),  # departure_delay
+        pgcopy.timestamp(departure.time),  # departure_time
+        pgcopy.int4(departure.uncertainty or None),  # departure_uncertainty
+        pgcopy.text(
+            getenum(model.StopTimeSchedule, entity.schedule_relationship, 2)
+        ),  # schedule_relationship
+    ]
 
-    sql = insert_stmt("rt.stop_time_updates", stu_cols)
 
-    for trip in trips:
-        trip_id = parse_trip(trip)[0]
-        stus = [parse_stoptimeupdate(stu) + [trip_id] for stu in trip.stop_time_update]
-        if stus:
-            execute_values(cursor, sql, stus)
+def binary_stoptime_updates(cursor, messageid, entities):
+    """
+    Like insert_stoptime_updates, but load stop time updates with binary COPY,
+    encoded straight from the protobuf fields.
+    """
+    trips, oids = insert_trip_updates(cursor, messageid, entities)
+    rows = []
+    for trip, oid in zip(trips, oids):
+        keys = [
+            pgcopy.text(trip.trip.trip_id),
+            pgcopy.int4(oid),
+            pgcopy.timestamp(trip.timestamp),
+        ]
+        rows.extend(encode_stoptimeupdate(stu) + keys for stu in trip.stop_time_update)
+    copy_binary(cursor, "rt.stop_time_updates", STOPTIME_COLS, rows)
+    return len(oids) + len(rows)
 
 
 def parse_replacement_period(entity):
@@ -334,9 +835,8 @@ def parse_replacement_period(entity):
 
 
 def insert_header(cursor, message):
-    sql = insert_stmt_returning("rt.messages", ['"timestamp"'], "oid")
-    execute_values(cursor, sql, [(fromtimestamp(message.header.timestamp),)])
-    messageid = cursor.fetchone()[0]
+    row = (fromtimestamp(message.header.timestamp),)
+    messageid = insert_returning(cursor, "rt.messages", ['"timestamp"'], [row])[0]
     # nyct_feed_header = message.header.Extensions[nyct_subway_pb2.nyct_feed_header]
     # replacement_periods = [parse_replacement_period(e) + [messageid]
     #                        for e in nyct_feed_header.trip_replacement_period]
@@ -366,6 +866,457 @@ def connection_params():
     return params
 
 
+def open_connection(synchronous_commit=None, timeout=None, **kwargs):
+    """
+    Connect using connection_params. timeout, in seconds, limits both
+    connecting and each statement. Other keyword arguments, such as
+    connection_factory, are passed to psycopg2.connect.
+    """
+    params = connection_params()
+    options = [os.environ.get("PGOPTIONS")]
+    if synchronous_commit:
+        options.append("-c synchronous_commit=" + synchronous_commit)
+    if timeout:
+        params["connect_timeout"] = max(2, round(timeout))
+        options.append("-c statement_timeout={:d}".format(round(timeout * 1000)))
+    if any(options):
+        params["options"] = " ".join(filter(None, options))
+    return psycopg2.connect(**params, **kwargs)
+
+
+Feed = namedtuple("Feed", ["url", "kinds", "interval"])
+
+# Ways of loading vehicle positions
+LOADERS = {
+    "insert": insert_vehicles,
+    "copy": copy_vehicles,
+    "columnar": columnar_vehicles,
+    "binary": binary_vehicles,
+}
+
+# Loaders that also change how stop time updates are written
+STOPTIME_LOADERS = {
+    "binary": binary_stoptime_updates,
+}
+
+
+def insert_functions(loader="insert"):
+    """
+    Map each feed kind to the function that inserts it. Each takes a cursor, the
+    oid of the message and its entities, and returns the number of rows it wrote.
+    """
+    return {
+        "alerts": insert_alerts,
+        "trips": insert_trips,
+        "positions": LOADERS[loader],
+        "stoptimes": STOPTIME_LOADERS.get(loader, insert_stoptime_updates),
+    }
+
+
+FEED_KINDS = ("alerts", "trips", "positions", "stoptimes")
+
+# The FeedEntity field holding each kind of feed data
+ENTITY_FIELDS = {
+    "alerts": "alert",
+    "trips": "trip_update",
+    "positions": "vehicle",
+    "stoptimes": "trip_update",
+}
+
+
+def count_entities(message, kinds):
+    """Count the entities in message holding each kind of feed data."""
+    return {
+        kind: sum(1 for e in message.entity if e.HasField(ENTITY_FIELDS[kind]))
+        for kind in kinds
+    }
+
+
+def parse_feed(value):
+    """Parse a --feed argument of the form KIND[,KIND...][@SECONDS]=URL."""
+    spec, sep, url = value.partition("=")
+    if not sep or not url:
+        raise ArgumentTypeError("expected KIND[,KIND...][@SECONDS]=URL")
+    spec, _, interval = spec.partition("@")
+    kinds = spec.split(",")
+    for kind in kinds:
+        if kind not in FEED_KINDS:
+            raise ArgumentTypeError(
+                "unknown feed kind {!r}, choose from {}".format(kind, ", ".join(FEED_KINDS))
+            )
+    # Stop time updates are loaded along with their trip updates
+    if "stoptimes" in kinds:
+        kinds = [k for k in kinds if k != "trips"]
+    try:
+        return Feed(url, tuple(kinds), float(interval) if interval else None)
+    except ValueError:
+        raise ArgumentTypeError("invalid interval {!r}".format(interval))
+
+
+def load(url, session=None, state=None, sample=None, timeout=HTTP_TIMEOUT):
+    """
+    Fetch and parse one feed message.
+    If state is a dict, it holds the cache validators, digest and header timestamp
+    of the last message written for this feed, and a message matching any is skipped.
+    If sample is given, the fetch and parse are timed in it (see metrics.new_sample).
+    Returns None for a skipped message, otherwise a tuple of the message, any parse
+    error, the updated state to record once the message is stored, and the raw payload.
+    """
+    sample = new_sample() if sample is None else sample
+    logging.debug("Opening %s", url)
+    with Stopwatch(sample["seconds"], "fetch"):
+        content, validators = fetch(url, session, state, timeout)
+    if content is None:
+        logging.debug("Skipping feed %s, not modified", url)
+        return None
+
+    sample["bytes"] = len(content)
+    digest = hashlib.sha1(content).hexdigest()
+    if state is not None and state.get("digest") == digest:
+        logging.debug("Skipping unchanged feed %s", url)
+        return None
+
+    with Stopwatch(sample["seconds"], "parse"):
+        message, error = parse_message(content, url)
+    timestamp = message.header.timestamp
+    if timestamp:
+        sample["lag"] = time.time() - timestamp
+    if state is not None and timestamp and timestamp == state.get("timestamp"):
+        logging.debug("Skipping feed %s, timestamp unchanged", url)
+        return None
+
+    return message, error, dict(validators, digest=digest, timestamp=timestamp), content
+
+
+def store(conn, url, inserts, message, error, atomic=False, sample=None):
+    """
+    Write a feed message with the given insert functions.
+    By default each insert is committed as it completes. With atomic, the header
+    and every insert are written in a single transaction.
+    If sample is given, each insert function is timed in it, both in all and
+    waiting on the database, under its name, and the rows it wrote are counted;
+    commits are timed as "commit".
+    """
+    sample = new_sample() if sample is None else sample
+    seconds, db_seconds = sample["seconds"], sample["db_seconds"]
+    written = sample["rows"]
+    with conn.cursor(cursor_factory=TimedCursor) as cursor:
+        if error or not message.ByteSize():
+            errormessage = getattr(error, "message", "ByteSize is 0")
+            insert_error(cursor, url, errormessage)
+            conn.commit()
+            return
+
+        # first insert the header
+        with Stopwatch(seconds, "header"):
+            messageid = insert_header(cursor, message)
+
+        for insert in inserts:
+            waited = cursor.seconds
+            with Stopwatch(seconds, insert.__name__):
+                written[insert.__name__] = insert(cursor, messageid, message.entity)
+            db_seconds[insert.__name__] = cursor.seconds - waited
+            if not atomic:
+                with Stopwatch(seconds, "commit"):
+                    conn.commit()
+
+        with Stopwatch(seconds, "commit"):
+            conn.commit()
+
+
+def load_and_archive(feed, session, state, sample, timeout=HTTP_TIMEOUT, archive=None):
+    """
+    Load a feed and, if archive is given, archive its payload, for a worker thread,
+    so that feeds are compressed in parallel and don't hold up each other's writes.
+    Returns what load returns.
+    """
+    loaded = load(feed.url, session, state, sample, timeout)
+    if loaded is None or archive is None:
+        return loaded
+    message, error, _, content = loaded
+    if not error:
+        name = "+".join(feed.kinds)
+        try:
+            with Stopwatch(sample["seconds"], "archive"):
+                archive.append(name, content, message.header.timestamp)
+        except OSError:
+            logging.exception("error archiving %s", name)
+    return loaded
+
+
+def load_and_store(
+    pool,
+    feed,
+    inserts,
+    session,
+    state,
+    sample,
+    atomic=False,
+    timeout=HTTP_TIMEOUT,
+    archive=None,
+):
+    """
+    Load and archive a feed, then store it on a connection borrowed from pool,
+    for a worker thread.
+    Returns what load returns, or None, and any OperationalError raised storing it.
+    """
+    loaded = load_and_archive(feed, session, state, sample, timeout, archive)
+    if loaded is None:
+        return None, None
+    message, error, _, _ = loaded
+    selected = [inserts[kind] for kind in feed.kinds]
+    try:
+        with pool.connection() as conn:
+            store(conn, feed.url, selected, message, error, atomic, sample)
+    except psycopg2.OperationalError as err:
+        return loaded, err
+    return loaded, None
+
+
+def poll(
+    conn,
+    feeds,
+    inserts,
+    session=None,
+    states=None,
+    atomic=False,
+    spool=None,
+    archive=None,
+    metrics=None,
+    http_timeout=HTTP_TIMEOUT,
+):
+    """
+    Fetch and parse feeds concurrently, writing each to the database as soon as it
+    is ready, so that one feed is downloaded and parsed while another is written.
+    inserts maps each feed kind to its insert function.
+    If conn is a ConnectionPool, each feed is written from its own worker thread on
+    a connection from the pool.
+    If archive is given, every new payload is also saved there, by the worker thread
+    that fetched it.
+    If conn is None or the database fails during the poll, payloads are written to
+    spool instead. Returns conn, or None if the database failed.
+    Other database errors are raised, but only once every feed has been handled.
+    Any other error is logged, and only fails its own feed.
+    If metrics is given, a sample of each feed's poll is recorded there.
+    """
+    if not feeds:
+        return conn
+    pooled = isinstance(conn, ConnectionPool)
+    failed = conn is None
+    # Database errors, raised once every feed has been handled, so that feeds
+    # already stored by other workers still have their state updated
+    errors = []
+    states = states or [None] * len(feeds)
+    samples = [new_sample() for _ in feeds]
+    with ThreadPoolExecutor(max_workers=len(feeds)) as executor:
+        futures = {}
+        for feed, state, sample in zip(feeds, states, samples):
+            if pooled:
+                args = (load_and_store, conn, feed, inserts)
+                args += (session, state, sample, atomic, http_timeout, archive)
+            else:
+                args = (load_and_archive, feed, session, state, sample)
+                args += (http_timeout, archive)
+            futures[executor.submit(*args)] = (feed, state, sample)
+
+        for future in as_completed(futures):
+            feed, state, sample = futures[future]
+            name = "+".join(feed.kinds)
+            sample["result"] = "error"
+            message = None
+            try:
+                try:
+                    loaded, err = future.result() if pooled else (future.result(), None)
+                except requests.RequestException as e:
+                    logging.error("error fetching %s: %s", feed_key(feed.url), e)
+                    continue
+                except psycopg2.Error as e:
+                    errors.append(e)
+                    continue
+
+                if loaded is None:
+                    sample["result"] = "skipped"
+                    continue
+
+                message, error, update, content = loaded
+                selected = [inserts[kind] for kind in feed.kinds]
+                if not pooled and not failed:
+                    try:
+                        store(conn, feed.url, selected, message, error, atomic, sample)
+                    except psycopg2.OperationalError as e:
+                        err = e
+                    except psycopg2.Error as e:
+                        # Such as a value out of range for its column: the
+                        # connection is still good for the other feeds
+                        conn.rollback()
+                        errors.append(e)
+                        continue
+
+                if err is not None:
+                    failed = True
+                    if spool is None:
+                        errors.append(err)
+                        continue
+                    logging.error("database error: %s", str(err).strip())
+
+                if failed and (not pooled or err is not None):
+                    if spool is None or error or not spool.append(name, content):
+                        continue
+                    sample["result"] = "spooled"
+                elif not error:
+                    sample["result"] = "stored"
+
+                if state is not None and not error:
+                    state.update(update)
+
+            except Exception:
+                # Such as a timestamp out of range, or a full disk: fail this feed
+                # alone, rather than the rest of the poll or a daemon
+                logging.exception("error polling %s", feed_key(feed.url))
+                sample["result"] = "error"
+                if not pooled and not failed:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        failed = True
+
+            finally:
+                if metrics is not None:
+                    if sample["result"] in ("stored", "spooled"):
+                        sample["entities"] = count_entities(message, feed.kinds)
+                    metrics.record(name, sample)
+
+    if errors:
+        raise errors[0]
+    return None if failed else conn
+
+
+def write_payloads(cursor, inserts, payloads, source):
+    """Parse raw payloads and write each message with the given insert functions."""
+    count = 0
+    for payload in payloads:
+        message, error = parse_message(payload, source)
+        if error or not message.ByteSize():
+            continue
+        messageid = insert_header(cursor, message)
+        for insert in inserts:
+            insert(cursor, messageid, message.entity)
+        count += 1
+    return count
+
+
+def drain(conn, spool, inserts):
+    """
+    Replay spooled payloads into the database, one transaction per spool file.
+    A file that the database rejects is set aside with a .failed suffix.
+    Does nothing if another process is draining the spool.
+    """
+    with spool.lock() as locked:
+        if not locked:
+            logging.info("spool %s is being drained elsewhere", spool.directory)
+            return
+        for name, path in spool.files():
+            try:
+                # Move the file aside, so that new payloads are appended to a fresh one.
+                # The name is unique, so an unfinished drain is never overwritten.
+                if path.endswith(".frames"):
+                    draining = "{}.{:d}.draining".format(path, time.time_ns())
+                    os.rename(path, draining)
+                    path = draining
+                f = open(path, "rb")
+            except FileNotFoundError:
+                # Drained or set aside by another process since it was listed
+                continue
+
+            selected = [inserts[kind] for kind in name.split("+")]
+            try:
+                with f, conn.cursor() as cursor:
+                    write_payloads(cursor, selected, read_frames(f), path)
+                conn.commit()
+
+            except psycopg2.OperationalError:
+                raise
+
+            except psycopg2.Error as err:
+                logging.error("database error draining %s: %s", path, str(err).strip())
+                conn.rollback()
+                os.rename(path, path[: -len(".draining")] + ".failed")
+                continue
+
+            os.remove(path)
+            logging.info("drained %s", path)
+
+
+def run_daemon(feeds, inserts, pool=None, spool=None, cache=None, **options):
+    """
+    Poll each feed on its own interval forever, reusing one HTTP session and a pool
+    of database connections, one per feed at most, each of which writes with
+    prepared statements. Unchanged messages are skipped, using state kept in memory.
+    pool is a ConnectionPool; options are passed to poll.
+    A connection that fails is dropped from the pool, and replaced when next needed.
+    While the database is unavailable, payloads are written to spool,
+    which is drained once the database is back.
+    If cache is a PositionCache, only positions that have changed are inserted.
+    It's cleared whenever a poll fails, since positions it recorded may not have
+    been stored. Spooled payloads are drained in full.
+    """
+    if pool is None:
+        connect = partial(open_connection, connection_factory=PreparedConnection)
+        pool = ConnectionPool(len(feeds), connect)
+    polled_inserts = inserts
+    if cache is not None:
+        polled_inserts = dict(inserts, positions=cache.wrap(inserts["positions"]))
+    session = requests.Session()
+    states = [{} for _ in feeds]
+    due = [0.0] * len(feeds)
+    try:
+        while True:
+            now = time.monotonic()
+            ready = [i for i in range(len(feeds)) if due[i] <= now]
+            for i in ready:
+                due[i] = now + feeds[i].interval
+
+            if spool is not None and spool.pending():
+                try:
+                    with pool.connection() as conn:
+                        drain(conn, spool, inserts)
+                except psycopg2.OperationalError as err:
+                    logging.error("database error: %s", str(err).strip())
+                except Exception:
+                    logging.exception("error draining %s", spool.directory)
+
+            try:
+                polled = poll(
+                    pool,
+                    [feeds[i] for i in ready],
+                    polled_inserts,
+                    session,
+                    [states[i] for i in ready],
+                    spool=spool,
+                    **options
+                )
+                if polled is None and cache is not None:
+                    cache.clear()
+            except psycopg2.Error as err:
+                logging.error("database error: %s", str(err).strip())
+                if cache is not None:
+                    cache.clear()
+            except Exception:
+                # poll fails feeds one at a time, so this is a bug: keep polling
+                logging.exception("error polling")
+                if cache is not None:
+                    cache.clear()
+
+            time.sleep(max(0, min(due) - time.monotonic()))
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        session.close()
+        pool.close()
+
+
 def main():
     desc = """
         Insert GTFS-rt data into a PostgreSQL database.
@@ -376,47 +1327,225 @@ def main():
         "--trip-updates", help="Fetch trip updates", action="store_true"
     )
     parser.add_argument(
-        "--stoptime-updates", help="Fetch stop time updates", action="store_true"
+        "--stoptime-updates",
+        help="Fetch stop time updates (implies --trip-updates)",
+        action="store_true",
     )
     parser.add_argument("--alerts", help="Fetch alerts", action="store_true")
     parser.add_argument(
         "--vehicle-positions", help="Fetch vehicle positions", action="store_true"
     )
-    parser.add_argument("url", help="GTFS-RT API endpoint")
+    parser.add_argument(
+        "--daemon",
+        help="Keep running, polling the feeds every INTERVAL seconds",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--interval",
+        help="Seconds between polls in daemon mode (default: 30)",
+        type=float,
+        default=30.0,
+    )
+    parser.add_argument(
+        "--loader",
+        help="How to load vehicle positions: multi-row INSERT, COPY, COPY from "
+        "columns read without building rows, or binary COPY, which also applies to "
+        "stop time updates (default: insert)",
+        choices=tuple(LOADERS),
+        default="insert",
+    )
+    parser.add_argument(
+        "--state-file",
+        help="JSON file recording the last message seen for each feed, "
+        "so that unchanged feeds are skipped between runs",
+    )
+    parser.add_argument(
+        "--single-transaction",
+        help="Write each feed message, header and all, in one transaction. "
+        "Implied by --spool",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--synchronous-commit",
+        help="Set synchronous_commit for the database session",
+        choices=("on", "off", "local", "remote_write", "remote_apply"),
+    )
+    parser.add_argument(
+        "--http-timeout",
+        help="Seconds to wait for a feed's server to connect or send data "
+        "(default: {:g})".format(HTTP_TIMEOUT),
+        type=float,
+        default=HTTP_TIMEOUT,
+    )
+    parser.add_argument(
+        "--db-timeout",
+        help="Seconds to wait for the database to connect or finish a statement",
+        type=float,
+    )
+    parser.add_argument(
+        "--spool",
+        help="Directory where payloads are kept while the database is unavailable",
+    )
+    parser.add_argument(
+        "--spool-max-mb",
+        help="Maximum size of the spool, in megabytes (default: 1024)",
+        type=float,
+        default=1024,
+    )
+    parser.add_argument(
+        "--drain",
+        help="Load the payloads in the spool into the database, then exit",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--archive",
+        help="Directory in which to save every raw payload, for replay.py",
+    )
+    parser.add_argument(
+        "--archive-format",
+        help="Compression for archived payloads (default: xz)",
+        choices=("xz", "zstd"),
+        default="xz",
+    )
+    parser.add_argument(
+        "--skip-unchanged-positions",
+        help="In daemon mode, don't insert positions that repeat the last one stored "
+        "for their vehicle (location, stop and timestamp)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--min-distance",
+        help="In daemon mode, also skip positions less than this many metres from the "
+        "last one stored for their vehicle, unless the stop has changed. "
+        "Implies --skip-unchanged-positions",
+        type=float,
+    )
+    parser.add_argument(
+        "--metrics-port",
+        help="In daemon mode, serve Prometheus metrics on this port at /metrics",
+        type=int,
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="Append a line of JSON with timings and counts for each feed to this file "
+        "after every run, or - for stdout",
+    )
+    parser.add_argument(
+        "--feed",
+        help="Fetch a feed, given as KIND[,KIND...][@SECONDS]=URL, where KIND is one of "
+        + ", ".join(FEED_KINDS)
+        + ". SECONDS overrides --interval for this feed. May be repeated.",
+        type=parse_feed,
+        action="append",
+        default=[],
+        dest="feeds",
+    )
+    parser.add_argument("url", nargs="?", help="GTFS-RT API endpoint")
 
     args = parser.parse_args()
 
     start_logger(logging.WARNING)
-
-    inserts = {
-        "alerts": insert_alerts,
-        "trip_updates": insert_trips,
-        "vehicle_positions": insert_vehicles,
-        "stoptime_updates": insert_stoptime_updates,
+    log_protobuf_backend()
+
+    inserts = insert_functions(args.loader)
+    # Stop time updates are keyed to trip updates, so insert_stoptime_updates writes both.
+    flags = {
+        "alerts": args.alerts,
+        "trips": args.trip_updates and not args.stoptime_updates,
+        "positions": args.vehicle_positions,
+        "stoptimes": args.stoptime_updates,
     }
-    try:
-        with psycopg2.connect(**connection_params()) as conn:
-            with conn.cursor() as cursor:
-                logging.debug("Opening %s", args.url)
-                message, error = load_message(args.url)
 
-                if error or not message.ByteSize():
-                    errormessage = getattr(error, "message", "ByteSize is 0")
-                    insert_error(cursor, args.url, errormessage)
-                    return
+    connect = partial(open_connection, args.synchronous_commit, args.db_timeout)
+    spool = Spool(args.spool, args.spool_max_mb * 2 ** 20) if args.spool else None
+    # A message that fails part-way is spooled whole, so none of it may be committed
+    atomic = args.single_transaction or spool is not None
+    options = {"atomic": atomic, "http_timeout": args.http_timeout}
+    if args.archive:
+        try:
+            options["archive"] = Archive(args.archive, args.archive_format)
+        except RuntimeError as err:
+            parser.error(str(err))
+
+    if (args.skip_unchanged_positions or args.min_distance) and not args.daemon:
+        parser.error("skipping unchanged positions requires --daemon")
+
+    if args.drain:
+        if spool is None:
+            parser.error("--drain requires --spool")
+        with connect() as conn:
+            drain(conn, spool, inserts)
+        return
+
+    feeds = list(args.feeds)
+    if args.url:
+        kinds = tuple(k for k in FEED_KINDS if flags[k])
+        if not kinds:
+            parser.error(
+                "give a url with at least one of --alerts, --trip-updates, "
+                "--stoptime-updates or --vehicle-positions"
+            )
+        feeds.append(Feed(args.url, kinds, None))
+    if not feeds:
+        parser.error("give a url or at least one --feed")
+    feeds = [feed._replace(interval=feed.interval or args.interval) for feed in feeds]
+
+    if args.metrics_port is not None or args.metrics_file:
+        options["metrics"] = Metrics()
+
+    if args.daemon:
+        if args.metrics_port is not None:
+            options["metrics"].serve(args.metrics_port)
+        if args.skip_unchanged_positions or args.min_distance:
+            options["cache"] = PositionCache(args.min_distance or 0)
+        connect = partial(
+            open_connection,
+            args.synchronous_commit,
+            args.db_timeout,
+            connection_factory=PreparedConnection,
+        )
+        pool = ConnectionPool(len(feeds), connect)
+        run_daemon(feeds, inserts, pool, spool, **options)
+        return
+
+    states = read_state(args.state_file) if args.state_file else None
+    feedstates = None
+    if states is not None:
+        feedstates = [states.setdefault(feed_key(f.url), {}) for f in feeds]
 
-                # first insert the header
-                messageid = insert_header(cursor, message)
+    try:
+        conn = connect()
+    except psycopg2.OperationalError as err:
+        logging.error("database error: %s", str(err).strip())
+        if spool is None:
+            sys.exit(1)
+        conn = None
 
-                for key, insert in inserts.items():
-                    if getattr(args, key):
-                        insert(cursor, messageid, message.entity)
-                        conn.commit()
+    # Payloads spooled by earlier runs are written once the database is back
+    if conn is not None and spool is not None and spool.pending():
+        try:
+            drain(conn, spool, inserts)
+        except psycopg2.OperationalError as err:
+            logging.error("database error: %s", str(err).strip())
+            conn.close()
+            conn = None
 
-    except psycopg2.ProgrammingError as err:
+    try:
+        poll(conn, feeds, inserts, states=feedstates, spool=spool, **options)
+
+    except psycopg2.Error as err:
         logging.error("database error: %s", str(err).strip())
         sys.exit(1)
 
+    finally:
+        # Even after an error, so that feeds already stored aren't stored again
+        if states is not None:
+            write_state(args.state_file, states)
+        if args.metrics_file:
+            write_metrics(args.metrics_file, options["metrics"])
+        if conn is not None:
+            conn.close()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,176 @@
+# metrics.py: record where each poll of a gtfs-realtime feed spends its time
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import time
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Prometheus help text for each metric. Those ending in _total are counters,
+# the rest are gauges describing each feed's latest poll.
+HELP = {
+    "gtfsrdb_polls_total": "Polls of each feed, by result",
+    "gtfsrdb_stage_seconds": "Seconds spent in each stage of the latest poll",
+    "gtfsrdb_stage_seconds_total": "Seconds spent in each stage",
+    "gtfsrdb_db_seconds": "Seconds of each insert stage spent waiting on the database",
+    "gtfsrdb_db_seconds_total": "Seconds of each insert stage spent waiting on the database",
+    "gtfsrdb_entities": "Entities of each kind in the latest message",
+    "gtfsrdb_entities_total": "Entities of each kind in messages stored or spooled",
+    "gtfsrdb_rows": "Rows written by each insert function for the latest message",
+    "gtfsrdb_rows_total": "Rows written by each insert function",
+    "gtfsrdb_payload_bytes": "Size of the latest payload",
+    "gtfsrdb_payload_bytes_total": "Bytes downloaded",
+    "gtfsrdb_feed_lag_seconds": "Age of the latest message's header timestamp when fetched",
+    "gtfsrdb_last_poll_timestamp_seconds": "Unix time of the latest poll",
+}
+
+
+def new_sample():
+    """
+    An empty record of one poll of one feed, filled in as the poll goes.
+    result is stored, skipped, spooled or error; seconds and db_seconds map
+    stages (fetch, parse, header, then each insert function) to elapsed time;
+    entities maps feed kinds to the number of entities in the message, and rows
+    maps insert functions to the number of rows they wrote.
+    """
+    return {
+        "result": None,
+        "bytes": 0,
+        "lag": None,
+        "seconds": {},
+        "db_seconds": {},
+        "entities": {},
+        "rows": {},
+    }
+
+
+class Stopwatch:
+    """Context manager that adds the seconds spent in it to a dict entry."""
+
+    def __init__(self, times, key):
+        self.times = times
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.times[self.key] = self.times.get(self.key, 0.0) + elapsed
+
+
+def series(sample):
+    """Yield (metric, labels, value) for a sample, labels being a tuple of pairs."""
+    yield "gtfsrdb_payload_bytes", (), sample["bytes"]
+    if sample["lag"] is not None:
+        yield "gtfsrdb_feed_lag_seconds", (), sample["lag"]
+    for stage, seconds in sample["seconds"].items():
+        yield "gtfsrdb_stage_seconds", (("stage", stage),), seconds
+    for stage, seconds in sample["db_seconds"].items():
+        yield "gtfsrdb_db_seconds", (("stage", stage),), seconds
+    for kind, count in sample["entities"].items():
+        yield "gtfsrdb_entities", (("kind", kind),), count
+    for insert, count in sample["rows"].items():
+        yield "gtfsrdb_rows", (("insert", insert),), count
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = (
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels
+    )
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metrics:
+    """
+    Per-feed samples from the latest poll, plus running totals since startup.
+    Gauges describe the latest poll that wasn't skipped, so that they aren't blanked
+    by polls of an unchanged feed. Samples are recorded by the polling thread and
+    read by the metrics server, so access is locked.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latest = {}
+        self.gauges = {}
+        self.totals = defaultdict(float)
+
+    def record(self, feed, sample):
+        with self.lock:
+            sample = dict(sample, time=time.time())
+            self.latest[feed] = sample
+            if sample["result"] != "skipped":
+                self.gauges[feed] = sample
+            result = (("feed", feed), ("result", sample["result"]))
+            self.totals["gtfsrdb_polls_total", result] += 1
+            for metric, labels, value in series(sample):
+                # Lag is a property of each message, so it makes no sense to add up
+                if metric != "gtfsrdb_feed_lag_seconds":
+                    self.totals[metric + "_total", (("feed", feed),) + labels] += value
+
+    def prometheus(self):
+        """Render the metrics in the Prometheus text exposition format."""
+        values = defaultdict(list)
+        with self.lock:
+            for (metric, labels), value in self.totals.items():
+                values[metric].append((labels, value))
+            for feed, sample in self.latest.items():
+                values["gtfsrdb_last_poll_timestamp_seconds"].append(
+                    ((("feed", feed),), sample["time"])
+                )
+            for feed, sample in self.gauges.items():
+                for metric, labels, value in series(sample):
+                    values[metric].append(((("feed", feed),) + labels, value))
+
+        lines = []
+        for metric in sorted(values):
+            lines.append("# HELP {} {}".format(metric, HELP[metric]))
+            kind = "counter" if metric.endswith("_total") else "gauge"
+            lines.append("# TYPE {} {}".format(metric, kind))
+            for labels, value in sorted(values[metric]):
+                lines.append("{}{} {!r}".format(metric, format_labels(labels), float(value)))
+        return "\n".join(lines) + "\n"
+
+    def json_line(self):
+        """The latest sample of every feed, as one line of JSON."""
+        with self.lock:
+            return json.dumps({"time": time.time(), "feeds": self.latest}, sort_keys=True)
+
+    def serve(self, port, host=""):
+        """Serve the metrics at /metrics from a background thread. Returns the server."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode("utf8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -78,3 +78,19 @@ class StopStatus(Enum):
     INCOMING_AT = 0
     STOPPED_AT = 1
     IN_TRANSIT_TO = 2
+
+
+# Member names by value for each enum, so that feeds can be parsed with dict
+# lookups rather than by constructing (and failing to construct) Enum members
+NAMES = {
+    cls: {member.value: member.name for member in cls}
+    for cls in (
+        OccupancyStatus,
+        CongestionLevel,
+        StopTimeSchedule,
+        TripSchedule,
+        AlertCause,
+        AlertEffect,
+        StopStatus,
+    )
+}
@@ -0,0 +1,73 @@
+# pgcopy.py: encode rows in PostgreSQL's binary COPY format
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+
+# Signature, flags and header extension length
+HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+TRAILER = struct.pack(">h", -1)
+
+COUNT = struct.Struct(">h")
+LENGTH = struct.Struct(">i")
+INT4 = struct.Struct(">ii")
+INT8 = struct.Struct(">iq")
+FLOAT8 = struct.Struct(">id")
+
+NULL = LENGTH.pack(-1)
+
+# Microseconds from the Unix epoch to PostgreSQL's, 2000-01-01
+PG_EPOCH = 946684800 * 1000000
+
+# Timestamps greater than this are in milliseconds, as in gtfsrdb.fromtimestamp
+MILLISECONDS = 568971820800
+
+# Each encoder returns a field, its length followed by its value, or NULL for None.
+
+
+def int4(value):
+    return NULL if value is None else INT4.pack(4, value)
+
+
+def int8(value):
+    return NULL if value is None else INT8.pack(8, value)
+
+
+def float8(value):
+    return NULL if value is None else FLOAT8.pack(8, value)
+
+
+def text(value):
+    """Encode a text (or enum) value. Like CSV COPY, treats the empty string as NULL."""
+    if not value:
+        return NULL
+    data = value.encode("utf8")
+    return LENGTH.pack(len(data)) + data
+
+
+def timestamp(value):
+    """Encode a POSIX timestamp as a timestamptz, treating 0 as NULL."""
+    if not value:
+        return NULL
+    if value > MILLISECONDS:
+        return INT8.pack(8, value * 1000 - PG_EPOCH)
+    return INT8.pack(8, value * 1000000 - PG_EPOCH)
+
+
+def write_rows(f, rows):
+    """Write a binary COPY stream to f. Each row is a sequence of encoded fields."""
+    f.write(HEADER)
+    for row in rows:
+        f.write(COUNT.pack(len(row)))
+        f.write(b"".join(row))
+    f.write(TRAILER)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# replay.py: load archived gtfs-realtime payloads into a database
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import logging
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+from gtfsrdb import (
+    FEED_KINDS,
+    LOADERS,
+    insert_functions,
+    open_connection,
+    start_logger,
+    write_payloads,
+)
+from archive import archive_files, archive_name, payloads
+
+
+def replay(path, inserts, kinds=None):
+    """Load one archive file in a single transaction. Returns the number of messages."""
+    kinds = kinds or archive_name(path).split("+")
+    selected = [inserts[kind] for kind in kinds]
+    conn = open_connection()
+    try:
+        with conn, conn.cursor() as cursor:
+            count = write_payloads(cursor, selected, payloads(path), path)
+    finally:
+        conn.close()
+    logging.info("%s: %d messages", path, count)
+    return count
+
+
+def main():
+    desc = """
+        Load payloads saved by gtfsrdb.py --archive into a PostgreSQL database.
+        Specify connection parameters using the standard PG* environment variables.
+    """
+    parser = ArgumentParser(description=desc)
+    parser.add_argument(
+        "--kinds",
+        help="Comma-separated feed kinds to load from every file ({}). "
+        "By default, taken from each file's feed directory".format(", ".join(FEED_KINDS)),
+        type=lambda x: x.split(","),
+    )
+    parser.add_argument(
+        "--loader",
+        help="How to load vehicle positions (default: copy)",
+        choices=tuple(LOADERS),
+        default="copy",
+    )
+    parser.add_argument(
+        "--jobs", help="Files to load at once (default: 1)", type=int, default=1
+    )
+    parser.add_argument(
+        "paths", nargs="+", help="Archive files, or directories to search for them"
+    )
+    args = parser.parse_args()
+
+    unknown = set(args.kinds or ()) - set(FEED_KINDS)
+    if unknown:
+        parser.error("unknown feed kinds: " + ", ".join(sorted(unknown)))
+
+    start_logger(logging.INFO)
+    inserts = insert_functions(args.loader)
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+            results = pool.map(
+                lambda path: replay(path, inserts, args.kinds), archive_files(args.paths)
+            )
+            total = sum(results)
+
+    except psycopg2.Error as err:
+        logging.error("database error: %s", str(err).strip())
+        sys.exit(1)
+
+    logging.info("loaded %d messages", total)
+
+
+if __name__ == "__main__":
+    main()
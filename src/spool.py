@@ -0,0 +1,112 @@
+# spool.py: keep raw gtfs-realtime payloads on disk while the database is unavailable
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import fcntl
+import struct
+import logging
+from contextlib import contextmanager
+
+# Each frame is a payload preceded by its length as a 4-byte big-endian integer.
+FRAME = struct.Struct(">I")
+
+
+def write_frame(f, payload):
+    f.write(FRAME.pack(len(payload)))
+    f.write(payload)
+
+
+def read_frames(f):
+    """Yield the payloads in a file of frames, ignoring a truncated final frame."""
+    while True:
+        head = f.read(FRAME.size)
+        if len(head) < FRAME.size:
+            break
+        (size,) = FRAME.unpack(head)
+        payload = f.read(size)
+        if len(payload) < size:
+            logging.warning("truncated frame in %s", getattr(f, "name", f))
+            break
+        yield payload
+
+
+class Spool:
+    """
+    An append-only directory of raw feed payloads, one subdirectory per feed name
+    and one file of frames per hour. Writes are fsync'd, and the whole spool is
+    capped at max_bytes: payloads that don't fit are dropped.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def size(self):
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        return total
+
+    def append(self, name, payload):
+        if self.size() + FRAME.size + len(payload) > self.max_bytes:
+            logging.error("spool %s is full, dropping %s payload", self.directory, name)
+            return False
+
+        dirname = os.path.join(self.directory, name)
+        os.makedirs(dirname, exist_ok=True)
+        path = os.path.join(dirname, time.strftime("%Y%m%d%H", time.gmtime()) + ".frames")
+        with open(path, "ab") as f:
+            write_frame(f, payload)
+            f.flush()
+            os.fsync(f.fileno())
+        return True
+
+    def files(self):
+        """
+        Yield (name, path) for each spool file, oldest first within each feed.
+        Files left part-way through draining are included, before any file of
+        the same hour spooled since; failed ones are not.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        for name in sorted(os.listdir(self.directory)):
+            dirname = os.path.join(self.directory, name)
+            if not os.path.isdir(dirname):
+                continue
+            filenames = [
+                f for f in os.listdir(dirname) if f.endswith((".frames", ".draining"))
+            ]
+            filenames.sort(key=lambda f: (f.split(".")[0], f.endswith(".frames"), f))
+            for filename in filenames:
+                yield name, os.path.join(dirname, filename)
+
+    def pending(self):
+        return any(True for _ in self.files())
+
+    @contextmanager
+    def lock(self):
+        """
+        Hold an exclusive lock on the spool while draining it, so that processes
+        started by cron don't drain the same files. Yields False, without waiting,
+        if another process holds it.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            yield True